@@ -1,3 +1,32 @@
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse
+
 from requests import Session
+from requests.adapters import HTTPAdapter
 
 session = Session()
+
+# as many connections kept alive as requests in flight (see aio.py)
+for prefix in ["http://", "https://"]:
+    session.mount(prefix, HTTPAdapter(pool_maxsize=32))
+
+_pool_sizes = dict()
+_mount_lock = threading.Lock()
+
+
+def mount(url: str, maxsize: int) -> None:
+    """Keep up to maxsize connections alive to the host of url."""
+    parsed = urlparse(url)
+    prefix = f"{parsed.scheme}://{parsed.netloc}/"
+    with _mount_lock:
+        if _pool_sizes.get(prefix, 0) < maxsize:
+            # Session.mount() reorders session.adapters in place, while
+            # other threads may iterate over it: swap in a new dict instead
+            adapters = OrderedDict(session.adapters)
+            adapters[prefix] = HTTPAdapter(pool_maxsize=maxsize)
+            # longest prefixes first, as with Session.mount()
+            session.adapters = OrderedDict(
+                sorted(adapters.items(), key=lambda item: -len(item[0]))
+            )
+            _pool_sizes[prefix] = maxsize
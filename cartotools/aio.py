@@ -0,0 +1,71 @@
+"""Asynchronous counterparts of the blocking requests session.
+
+aiohttp is an optional dependency, only necessary for the a* methods
+(Overpass.aquery, location.aget, Cache.aget_image, etc.).
+"""
+
+import asyncio
+import weakref
+from functools import partial
+from typing import Any, Callable, Mapping, NamedTuple
+
+# maximum number of requests in flight, for each event loop
+max_concurrency = 32
+
+_sessions: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_semaphores: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+class Reply(NamedTuple):
+    status: int
+    headers: Mapping[str, str]  # case-insensitive, as in HTTP
+    content: bytes
+
+
+def session():
+    import aiohttp  # leave it as optional import
+
+    loop = asyncio.get_event_loop()
+    client = _sessions.get(loop, None)
+    if client is None or client.closed:
+        client = _sessions[loop] = aiohttp.ClientSession()
+    return client
+
+
+def semaphore() -> asyncio.Semaphore:
+    loop = asyncio.get_event_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(max_concurrency)
+    return _semaphores[loop]
+
+
+async def close() -> None:
+    """Close the session attached to the running event loop."""
+    client = _sessions.pop(asyncio.get_event_loop(), None)
+    if client is not None:
+        await client.close()
+
+
+async def run(function: Callable, *args, **kwargs) -> Any:
+    """Run blocking code (disk access, parsing) in the default executor."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, partial(function, *args, **kwargs))
+
+
+async def request(
+    method: str, url: str, timeout: float = 180, **kwargs
+) -> Reply:
+    import aiohttp  # leave it as optional import
+    from multidict import CIMultiDict  # installed with aiohttp
+
+    async with semaphore():
+        async with session().request(
+            method,
+            url,
+            timeout=aiohttp.ClientTimeout(total=timeout),
+            **kwargs,
+        ) as response:
+            content = await response.read()
+            # a copy, still case-insensitive (e.g. for retry-after)
+            headers = CIMultiDict(response.headers)
+            return Reply(response.status, headers, content)
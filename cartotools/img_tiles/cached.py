@@ -1,21 +1,138 @@
+import asyncio
+import io
 import os
+import threading
+from collections import Counter, OrderedDict
 
 import numpy as np
 from concurrent import futures
 from PIL import Image
 
-from cartopy.io.img_tiles import _merge_tiles
 from appdirs import user_cache_dir
 
+from .storage import DirectoryStore, MBTilesStore, migrate
+
 global_cache_dir = user_cache_dir("cartotools")
 if not os.path.isdir(global_cache_dir):
     os.makedirs(global_cache_dir)
 
 
+class DecodedTiles(object):
+    """Process-wide LRU of decoded tiles, as arrays.
+
+    Entries are keyed by provider and tile; arrays are read-only as they
+    are shared.
+    """
+
+    max_bytes = 256 << 20
+
+    def __init__(self):
+        self.data = OrderedDict()
+        self.nbytes = 0
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key):
+        with self.lock:
+            img = self.data.get(key, None)
+            if img is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            self.data.move_to_end(key)
+            return img
+
+    def put(self, key, img):
+        img.flags.writeable = False
+        with self.lock:
+            if key in self.data:
+                return
+            self.data[key] = img
+            self.nbytes += img.nbytes
+            while len(self.data) > 1 and self.nbytes > self.max_bytes:
+                _, evicted = self.data.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.nbytes = 0
+
+
+decoded_tiles = DecodedTiles()
+
+
+class Mosaic(object):
+    """One image for a grid of tiles, allocated once.
+
+    Each tile is copied in its own slot (lower origin) as soon as it is
+    decoded; tiles never received are left white.
+    """
+
+    def __init__(self, tiles, tileextent):
+        if len(tiles) == 0:
+            raise ValueError("No tile to build the image")
+        xs, ys, zs = zip(*tiles)
+        self.x0, self.y0 = min(xs), min(ys)
+        self.shape = max(ys) - self.y0 + 1, max(xs) - self.x0 + 1
+        self.img = None
+        self.lock = threading.Lock()
+
+        z = zs[0]
+        corners = [
+            tileextent((self.x0, self.y0, z)),
+            tileextent((max(xs), max(ys), z)),
+        ]
+        self.extent = [
+            min(c[0] for c in corners),
+            max(c[1] for c in corners),
+            min(c[2] for c in corners),
+            max(c[3] for c in corners),
+        ]
+
+    def paste(self, tile, img):
+        with self.lock:
+            if self.img is None:
+                rows, cols = self.shape
+                height, width = img.shape[:2]
+                self.img = np.full(
+                    (rows * height, cols * width) + img.shape[2:],
+                    255,
+                    dtype=np.uint8,
+                )
+        height, width = img.shape[:2]
+        # tiles are numbered from the north, image rows from the south
+        row = self.shape[0] - 1 - (tile[1] - self.y0)
+        col = tile[0] - self.x0
+        self.img[
+            row * height : (row + 1) * height, col * width : (col + 1) * width
+        ] = img[::-1]
+
+    def result(self):
+        if self.img is None:
+            raise ValueError("No tile available to build the image")
+        return self.img, self.extent, "lower"
+
+
+# download pools, shared by all instances of a tile provider
+executors = dict()
+executors_lock = threading.Lock()
+
+
 class Cache(object):
 
     extension = ".jpg"
 
+    # concurrent downloads for this provider
+    max_workers = 20
+
+    # "directory" (one file per tile) or "mbtiles" (one SQLite file)
+    storage = "directory"
+
     def __init__(self, *args, **kwargs):
         super(Cache, self).__init__(*args, **kwargs)
         self.params = {}
@@ -33,52 +150,187 @@ class Cache(object):
 
         tileset_name = "{}".format(self.__class__.__name__.lower())
         self.cache_dir = os.path.join(global_cache_dir, tileset_name)
-        if not os.path.exists(self.cache_dir):
-            os.makedirs(self.cache_dir)
+        self.store = self.make_store()
+
+    def make_store(self):
+        if self.storage == "mbtiles":
+            return MBTilesStore(
+                self.cache_dir + ".mbtiles", format=self.extension[1:]
+            )
+        return DirectoryStore(self.cache_dir, self.extension)
 
-    def get_image(self, tile):
-        from .. import session
+    def migrate(self, storage):
+        """Copy cached tiles to another storage, used from now on."""
+        source = self.store
+        self.storage = storage
+        self.store = self.make_store()
+        return migrate(source, self.store)
 
-        tile_fname = os.path.join(
-            self.cache_dir, "_".join(str(v) for v in tile) + self.extension
-        )
+    @property
+    def executor(self):
+        """Thread pool of the provider, created once, sized max_workers."""
+        from .. import mount
+
+        name = type(self).__name__
+        with executors_lock:
+            max_workers, executor = executors.get(name, (None, None))
+            if max_workers != self.max_workers:
+                if executor is not None:
+                    executor.shutdown(wait=False)
+                # one kept-alive connection per worker, mounted once
+                mount(self._image_url((0, 0, 0)), self.max_workers)
+                executor = futures.ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix=name
+                )
+                executors[name] = self.max_workers, executor
+        return executor
+
+    def decode(self, content):
+        img = Image.open(io.BytesIO(content))
+        return img.convert(self.desired_tile_form)
 
-        if not os.path.exists(tile_fname):
-            response = session.get(
-                self._image_url(tile), stream=True, **self.params
+    def get_image(self, tile, content=None):
+        from ..singleflight import flights
+
+        if content is None:
+            content = self.store.get(tile)
+
+        if content is None:
+            # concurrent calls for the same tile share the download
+            content = flights.do(
+                "tiles", self.store.key(tile), self.download, tile
             )
 
-            with open(tile_fname, "wb") as fh:
-                for chunk in response:
-                    fh.write(chunk)
+        img = self.decode(content)
+
+        return img, self.tileextent(tile), "lower"
+
+    def download(self, tile):
+        from ..scheduler import scheduler
+
+        content = self.store.get(tile)
+        if content is not None:  # downloaded by another process
+            return content
+
+        url = self._image_url(tile)
+        response = scheduler.request("GET", url, stream=True, **self.params)
+        # never store an error page as a tile
+        if response.status_code != 200:
+            response.close()
+            raise IOError(f"Error {response.status_code} for tile {tile}")
+        content = b"".join(response)
+        self.store.put(tile, content)
+        return content
+
+    async def aget_image(self, tile):
+        """Asynchronous version of get_image."""
+        from .. import aio
+        from ..singleflight import flights
 
-        with open(tile_fname, "rb") as fh:
-            img = Image.open(fh)
-            img = img.convert(self.desired_tile_form)
+        content = await aio.run(self.store.get, tile)
+
+        if content is None:
+            content = await flights.ado(
+                "tiles", self.store.key(tile), self.adownload, tile
+            )
+
+        img = await aio.run(self.decode, content)
 
         return img, self.tileextent(tile), "lower"
 
-    def one_image(self, tile):
-        img, extent, origin = self.get_image(tile)
-        img = np.array(img)
+    async def adownload(self, tile):
+        """Asynchronous version of download."""
+        from .. import aio
+        from ..scheduler import scheduler
+
+        reply = await scheduler.arequest(
+            "GET", self._image_url(tile), **self.params
+        )
+        if reply.status != 200:
+            raise IOError(f"Error {reply.status} for tile {tile}")
+
+        await aio.run(self.store.put, tile, reply.content)
+        return reply.content
+
+    def decoded_key(self, tile):
+        return self.cache_dir, self.desired_tile_form, tuple(tile)
+
+    def tile_image(self, tile, content=None):
+        """Decoded tile, as an array, from memory if possible."""
+        key = self.decoded_key(tile)
+        img = decoded_tiles.get(key)
+        if img is None:
+            if content is None:  # subclasses may override get_image(tile)
+                img, _, _ = self.get_image(tile)
+            else:
+                img, _, _ = self.get_image(tile, content)
+            img = np.asarray(img)
+            decoded_tiles.put(key, img)
+        return img
+
+    async def atile_image(self, tile):
+        """Asynchronous version of tile_image."""
+        key = self.decoded_key(tile)
+        img = decoded_tiles.get(key)
+        if img is None:
+            img, _, _ = await self.aget_image(tile)
+            img = np.asarray(img)
+            decoded_tiles.put(key, img)
+        return img
+
+    def one_image(self, tile, content=None):
+        img = self.tile_image(tile, content)
+        return self.tile_array(img, self.tileextent(tile), "lower")
+
+    async def aone_image(self, tile):
+        img = await self.atile_image(tile)
+        return self.tile_array(img, self.tileextent(tile), "lower")
+
+    def tile_array(self, img, extent, origin):
+        img = np.asarray(img)
         x = np.linspace(extent[0], extent[1], img.shape[1])
         y = np.linspace(extent[2], extent[3], img.shape[0])
         return [img, x, y, origin]
 
     def image_for_domain(self, target_domain, target_z):
-        tiles = []
-        with futures.ThreadPoolExecutor(max_workers=20) as executor:
-            todo = {}
-            for tile in self.find_images(target_domain, target_z):
-                future = executor.submit(self.one_image, tile)
-                todo[future] = tile
-
-            done_iter = futures.as_completed(todo)
-            for future in done_iter:
-                try:
-                    res = future.result()
-                except IOError:
-                    continue
-                tiles.append(res)
-        img, extent, origin = _merge_tiles(tiles)
-        return img, extent, origin
+        domain = list(self.find_images(target_domain, target_z))
+        # tiles not decoded yet are read from storage in one batch
+        contents = self.store.get_many(
+            tile
+            for tile in domain
+            if self.decoded_key(tile) not in decoded_tiles
+        )
+        mosaic = Mosaic(domain, self.tileextent)
+
+        def paste(tile, content):
+            mosaic.paste(tile, self.tile_image(tile, content))
+
+        todo = {}
+        for tile in domain:
+            future = self.executor.submit(
+                paste, tile, contents.get(tuple(tile), None)
+            )
+            todo[future] = tile
+
+        for future in futures.as_completed(todo):
+            try:
+                future.result()
+            except IOError:
+                continue
+        return mosaic.result()
+
+    async def aimage_for_domain(self, target_domain, target_z):
+        """Asynchronous version of image_for_domain."""
+        domain = list(self.find_images(target_domain, target_z))
+        mosaic = Mosaic(domain, self.tileextent)
+
+        async def paste(tile):
+            mosaic.paste(tile, await self.atile_image(tile))
+
+        results = await asyncio.gather(
+            *(paste(tile) for tile in domain), return_exceptions=True
+        )
+        for res in results:
+            if isinstance(res, BaseException) and not isinstance(res, IOError):
+                raise res
+        return mosaic.result()
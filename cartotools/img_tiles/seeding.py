@@ -0,0 +1,165 @@
+"""Fill tile caches ahead of time, e.g. before going offline.
+
+    cartotools-seed OSM --bbox 1 43 2 44 --zoom 8-12
+    cartotools-seed ArcGIS --where Toulouse --zoom 10-14 --dry-run
+"""
+
+import argparse
+import logging
+import time
+from concurrent import futures
+from itertools import chain
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Union
+
+from shapely.geometry import base, box
+
+__all__ = ["seed"]
+
+# bytes, to estimate disk usage when no tile is cached yet
+default_tile_size = 20000
+
+
+class SeedReport(NamedTuple):
+    tiles: int
+    cached: int  # before seeding
+    downloaded: int
+    failed: int
+    nbytes: int  # estimated for dry runs
+    duration: float
+
+
+def target_domain(tiles, where) -> base.BaseGeometry:
+    """Domain in the projection of the tiles."""
+    import cartopy.crs as ccrs
+
+    if isinstance(where, str):
+        from ..osm import location
+
+        where = location(where).shape
+    if not isinstance(where, base.BaseGeometry):
+        where = box(*where)
+    return tiles.crs.project_geometry(where, ccrs.PlateCarree())
+
+
+def seed(
+    tiles,
+    where: Union[str, Sequence[float], base.BaseGeometry],
+    zooms: Union[int, Iterable[int]],
+    dry_run: bool = False,
+    batch_size: int = 1000,
+) -> SeedReport:
+    """Download all tiles of a region for the given zoom levels.
+
+    where is a name (geocoded with Nominatim), a bounding box (west,
+    south, east, north) or a shape, in degrees. Tiles already cached are
+    skipped, so that an interrupted seeding resumes where it stopped.
+
+    With dry_run, nothing is downloaded; the size on disk is estimated
+    from the size of tiles already cached.
+    """
+    if isinstance(zooms, int):
+        zooms = [zooms]
+    domain = target_domain(tiles, where)
+    domain_tiles: List = list(
+        chain.from_iterable(tiles.find_images(domain, z) for z in zooms)
+    )
+    total = len(domain_tiles)
+    logging.info(f"{total} tiles for zoom levels {list(zooms)}")
+
+    start = time.time()
+    cached = downloaded = failed = nbytes = 0
+    for i in range(0, total, batch_size):
+        batch = domain_tiles[i : i + batch_size]
+        sizes = tiles.store.sizes(batch)
+        cached += len(sizes)
+        nbytes += sum(sizes.values())
+        missing = [tile for tile in batch if tile not in sizes]
+        if dry_run:
+            continue
+
+        todo = {tiles.executor.submit(tiles.download, t): t for t in missing}
+        try:
+            for future in futures.as_completed(todo):
+                try:
+                    nbytes += len(future.result())
+                    downloaded += 1
+                except Exception as e:
+                    logging.warning(f"Failed to download {todo[future]}: {e}")
+                    failed += 1
+        except KeyboardInterrupt:
+            for future in todo:
+                future.cancel()
+            logging.warning("Interrupted: run again to resume")
+            raise
+
+        duration = time.time() - start
+        logging.info(
+            f"{i + len(batch)}/{total} tiles, {cached} already cached, "
+            f"{downloaded / duration:.1f} tiles/s"
+        )
+
+    if dry_run:
+        average = nbytes / cached if cached > 0 else default_tile_size
+        nbytes += int(average * (total - cached))
+
+    return SeedReport(
+        total, cached, downloaded, failed, nbytes, time.time() - start
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    from .. import img_tiles
+    from .cached import Cache
+
+    parser = argparse.ArgumentParser(
+        prog="cartotools-seed", description="Fill the cache of a tile server"
+    )
+    parser.add_argument("provider", help="tile class, e.g. OSM, ArcGIS")
+    parser.add_argument(
+        "--bbox",
+        nargs=4,
+        type=float,
+        metavar=("WEST", "SOUTH", "EAST", "NORTH"),
+    )
+    parser.add_argument("--where", help="a place name, geocoded on OSM")
+    parser.add_argument(
+        "--zoom", required=True, help="a zoom level or a range, e.g. 8-12"
+    )
+    parser.add_argument("--workers", type=int, help="concurrent downloads")
+    parser.add_argument("--storage", choices=["directory", "mbtiles"])
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="count tiles and estimate disk usage only",
+    )
+    args = parser.parse_args(argv)
+
+    if (args.bbox is None) == (args.where is None):
+        parser.error("one of --bbox or --where is necessary")
+
+    cls = getattr(img_tiles, args.provider, None)
+    if not isinstance(cls, type) or not issubclass(cls, Cache):
+        parser.error(f"unknown tile provider {args.provider}")
+    if args.workers is not None:
+        cls.max_workers = args.workers
+    if args.storage is not None:
+        cls.storage = args.storage
+
+    first, _, last = args.zoom.partition("-")
+    zooms = range(int(first), int(last or first) + 1)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    report = seed(cls(), args.bbox or args.where, zooms, dry_run=args.dry_run)
+
+    size = report.nbytes / 2**20
+    if args.dry_run:
+        print(
+            f"{report.tiles} tiles, {report.cached} already cached, "
+            f"about {size:.1f} MB on disk"
+        )
+    else:
+        print(
+            f"{report.downloaded} tiles downloaded, {report.cached} already "
+            f"cached, {report.failed} failed, {size:.1f} MB on disk "
+            f"in {report.duration:.1f}s"
+        )
@@ -0,0 +1,216 @@
+"""Storage backends for cached tiles.
+
+Tiles are identified by their (x, y, z) tuple, as in cartopy, and stored as
+encoded bytes (jpg, png).
+"""
+
+import os
+import sqlite3
+import threading
+from collections import defaultdict
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+__all__ = ["DirectoryStore", "MBTilesStore", "migrate"]
+
+Tile = Tuple[int, int, int]
+
+
+class DirectoryStore(object):
+    """One file per tile, named x_y_z.extension, in a directory."""
+
+    def __init__(self, directory: str, extension: str) -> None:
+        self.directory = directory
+        self.extension = extension
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def filename(self, tile: Tile) -> str:
+        return os.path.join(
+            self.directory, "_".join(str(v) for v in tile) + self.extension
+        )
+
+    def key(self, tile: Tile) -> str:
+        return self.filename(tile)
+
+    def __contains__(self, tile: Tile) -> bool:
+        return os.path.exists(self.filename(tile))
+
+    def get(self, tile: Tile) -> Optional[bytes]:
+        try:
+            with open(self.filename(tile), "rb") as fh:
+                return fh.read()
+        except FileNotFoundError:
+            return None
+
+    def get_many(self, tiles: Iterable[Tile]) -> Dict[Tile, bytes]:
+        result = dict()
+        for tile in tiles:
+            content = self.get(tile)
+            if content is not None:
+                result[tile] = content
+        return result
+
+    def sizes(self, tiles: Iterable[Tile]) -> Dict[Tile, int]:
+        """Size in bytes of the tiles which are stored."""
+        result = dict()
+        for tile in tiles:
+            try:
+                result[tile] = os.path.getsize(self.filename(tile))
+            except FileNotFoundError:
+                continue
+        return result
+
+    def put(self, tile: Tile, content: bytes) -> None:
+        # readers never see a partial file; one temporary file per thread,
+        # as the same tile may be written by several threads at once
+        filename = self.filename(tile)
+        tmp_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_filename, "wb") as fh:
+            fh.write(content)
+        os.replace(tmp_filename, filename)
+
+    def put_many(self, items: Iterable[Tuple[Tile, bytes]]) -> None:
+        for tile, content in items:
+            self.put(tile, content)
+
+    def tiles(self) -> Iterator[Tile]:
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.extension):
+                continue
+            try:
+                x, y, z = (
+                    int(v) for v in name[: -len(self.extension)].split("_")
+                )
+            except ValueError:
+                continue
+            yield x, y, z
+
+
+class MBTilesStore(object):
+    """All tiles in one SQLite file, following the MBTiles specification.
+
+    The database is in WAL mode so that readers in other threads and
+    processes are not blocked by downloads being written.
+    """
+
+    def __init__(self, filename: str, format: str = "png") -> None:
+        self.filename = filename
+        self.local = threading.local()
+        directory = os.path.dirname(filename)
+        if directory != "" and not os.path.exists(directory):
+            os.makedirs(directory)
+        conn = self.connection()
+        with conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, "
+                "tile_column INTEGER, tile_row INTEGER, tile_data BLOB)"
+            )
+            conn.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS tile_index "
+                "ON tiles (zoom_level, tile_column, tile_row)"
+            )
+            if conn.execute("SELECT count(*) FROM metadata").fetchone()[0] == 0:
+                name = os.path.splitext(os.path.basename(filename))[0]
+                conn.executemany(
+                    "INSERT INTO metadata VALUES (?, ?)",
+                    [("name", name), ("format", format)],
+                )
+
+    def connection(self) -> sqlite3.Connection:
+        # one connection per thread, kept open
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.filename, timeout=30)
+        return conn
+
+    @staticmethod
+    def row(y: int, z: int) -> int:
+        # MBTiles rows follow the TMS scheme, from the south
+        return (1 << z) - 1 - y
+
+    def key(self, tile: Tile) -> str:
+        return f"{self.filename}:{tile}"
+
+    def __contains__(self, tile: Tile) -> bool:
+        return self.get(tile) is not None
+
+    def get(self, tile: Tile) -> Optional[bytes]:
+        x, y, z = tile
+        row = (
+            self.connection()
+            .execute(
+                "SELECT tile_data FROM tiles WHERE zoom_level = ? "
+                "AND tile_column = ? AND tile_row = ?",
+                (z, x, self.row(y, z)),
+            )
+            .fetchone()
+        )
+        return row[0] if row is not None else None
+
+    def select(self, column: str, tiles: Iterable[Tile]) -> Dict[Tile, Any]:
+        """Query tiles with one query per zoom level, on their extent."""
+        by_zoom = defaultdict(set)
+        for x, y, z in tiles:
+            by_zoom[z].add((x, y))
+
+        result = dict()
+        for z, wanted in by_zoom.items():
+            xs = [x for x, _ in wanted]
+            rows = [self.row(y, z) for _, y in wanted]
+            cursor = self.connection().execute(
+                f"SELECT tile_column, tile_row, {column} FROM tiles "
+                "WHERE zoom_level = ? AND tile_column BETWEEN ? AND ? "
+                "AND tile_row BETWEEN ? AND ?",
+                (z, min(xs), max(xs), min(rows), max(rows)),
+            )
+            for x, row, value in cursor:
+                y = self.row(row, z)
+                if (x, y) in wanted:
+                    result[(x, y, z)] = value
+        return result
+
+    def get_many(self, tiles: Iterable[Tile]) -> Dict[Tile, bytes]:
+        return self.select("tile_data", tiles)
+
+    def sizes(self, tiles: Iterable[Tile]) -> Dict[Tile, int]:
+        """Size in bytes of the tiles which are stored."""
+        return self.select("length(tile_data)", tiles)
+
+    def put(self, tile: Tile, content: bytes) -> None:
+        self.put_many([(tile, content)])
+
+    def put_many(self, items: Iterable[Tuple[Tile, bytes]]) -> None:
+        conn = self.connection()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)",
+                (
+                    (z, x, self.row(y, z), sqlite3.Binary(content))
+                    for (x, y, z), content in items
+                ),
+            )
+
+    def tiles(self) -> Iterator[Tile]:
+        cursor = self.connection().execute(
+            "SELECT tile_column, tile_row, zoom_level FROM tiles"
+        )
+        for x, row, z in cursor.fetchall():
+            yield x, self.row(row, z), z
+
+
+def migrate(source, destination, batch_size: int = 1000) -> int:
+    """Copy all tiles from a store to another, return how many."""
+    tiles = source.tiles()
+    count = 0
+    while True:
+        batch = list(islice(tiles, batch_size))
+        if len(batch) == 0:
+            return count
+        contents = source.get_many(batch)
+        destination.put_many(contents.items())
+        count += len(contents)
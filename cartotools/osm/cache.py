@@ -0,0 +1,530 @@
+import atexit
+import json
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict, UserDict
+from functools import partial
+from itertools import chain
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from appdirs import user_cache_dir
+
+from .elements import NodeStore, PackedWays
+from .response import Response
+from .stream import chunk_size, dump
+
+__all__ = ["OSMCache"]
+
+arrays = [
+    "node_ids",
+    "node_lon",
+    "node_lat",
+    "way_ids",
+    "way_offsets",
+    "way_nodes",
+]
+
+
+def write_columnar(directory: Path, response: Response) -> None:
+    """Write a response as a directory of contiguous arrays.
+
+    Each array is a .npy file which can be memory-mapped; tags, relations
+    and areas go along in a JSON file.
+    """
+    ways = response.ways.packed()
+
+    content = {
+        "node_ids": response.nodes.ids,
+        "node_lon": response.nodes.lon,
+        "node_lat": response.nodes.lat,
+        "way_ids": ways.ids,
+        "way_offsets": ways.offsets,
+        "way_nodes": ways.refs,
+    }
+    attributes = {
+        "header": response.header,
+        "nodes": response.nodes.attributes,
+        "ways": ways.attributes,
+        "relations": list(response.relations.values()),
+        "areas": list(response.areas.values()),
+    }
+
+    # write everything aside, then move in place
+    tmp = Path(tempfile.mkdtemp(dir=directory.parent, prefix=".tmp"))
+    try:
+        for name in arrays:
+            np.save(tmp / f"{name}.npy", content[name])
+        with (tmp / "attributes.json").open("w") as fh:
+            json.dump(attributes, fh)
+        if directory.exists():
+            shutil.rmtree(directory)
+        tmp.rename(directory)
+    finally:
+        if tmp.exists():
+            shutil.rmtree(tmp)
+
+
+def read_columnar(directory: Path, name: str) -> Response:
+    """Memory-map a response written by write_columnar."""
+    content = {
+        key: np.load(directory / f"{key}.npy", mmap_mode="r") for key in arrays
+    }
+    attributes = json.loads((directory / "attributes.json").read_text())
+
+    def int_keys(d):  # JSON object keys are always strings
+        return {int(key): value for key, value in d.items()}
+
+    nodes = NodeStore(
+        content["node_ids"],
+        content["node_lon"],
+        content["node_lat"],
+        int_keys(attributes["nodes"]),
+    )
+    ways = PackedWays(
+        content["way_ids"],
+        content["way_offsets"],
+        content["way_nodes"],
+        int_keys(attributes["ways"]),
+    )
+    return Response.from_stores(
+        attributes["header"],
+        nodes,
+        ways,
+        {p["id"]: p for p in attributes["relations"]},
+        {p["id"]: p for p in attributes["areas"]},
+        name,
+        lazy=True,
+    )
+
+
+def disk_size(path: Path) -> int:
+    if path.is_dir():
+        return sum(f.stat().st_size for f in path.iterdir())
+    return path.stat().st_size
+
+
+class Entry(NamedTuple):
+    hashcode: str
+    query: Optional[str]
+    timestamp: Optional[str]  # timestamp_osm_base
+    downloaded: float
+    size: int
+    last_access: float
+    # structure of queries on a bounding box: query without the bbox
+    spec: Optional[str] = None
+    west: Optional[float] = None
+    south: Optional[float] = None
+    east: Optional[float] = None
+    north: Optional[float] = None
+
+
+class Manifest(object):
+    """SQLite index of the entries stored on disk.
+
+    Freshness checks, listing and eviction only need this index, so
+    payloads are never parsed for these purposes.
+
+    Access times are kept in memory and written in batches, so that hits
+    on the cache do not write to disk.
+    """
+
+    # pending access times written at once
+    flush_after = 256
+
+    def __init__(self, filename: Path) -> None:
+        self.filename = filename
+        self.local = threading.local()
+        self.accessed: Dict[str, float] = dict()
+        self.lock = threading.Lock()
+        atexit.register(self.flush)
+        self.execute("PRAGMA journal_mode=WAL")
+        self.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "hashcode TEXT PRIMARY KEY, query TEXT, timestamp TEXT, "
+            "downloaded REAL, size INTEGER, last_access REAL)"
+        )
+        # columns added after the first version of the manifest
+        columns = set(
+            row[1] for row in self.execute("PRAGMA table_info(entries)")
+        )
+        for column, type_ in [
+            ("spec", "TEXT"),
+            ("west", "REAL"),
+            ("south", "REAL"),
+            ("east", "REAL"),
+            ("north", "REAL"),
+        ]:
+            if column not in columns:
+                self.execute(f"ALTER TABLE entries ADD COLUMN {column} {type_}")
+
+    def connection(self) -> sqlite3.Connection:
+        # one connection per thread, kept open
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(
+                str(self.filename), timeout=30
+            )
+        return conn
+
+    def execute(self, sql: str, *args) -> List[Tuple]:
+        conn = self.connection()
+        with conn:
+            return conn.execute(sql, args).fetchall()
+
+    def flush(self) -> None:
+        """Write pending access times."""
+        with self.lock:
+            accessed, self.accessed = self.accessed, dict()
+        if len(accessed) == 0:
+            return
+        conn = self.connection()
+        with conn:
+            conn.executemany(
+                "UPDATE entries SET last_access = ? WHERE hashcode = ?",
+                ((last, hashcode) for hashcode, last in accessed.items()),
+            )
+
+    def get(self, hashcode: str) -> Optional[Entry]:
+        rows = self.execute(
+            "SELECT * FROM entries WHERE hashcode = ?", hashcode
+        )
+        return Entry(*rows[0]) if len(rows) > 0 else None
+
+    def entries(self) -> List[Entry]:
+        """All entries, least recently accessed first."""
+        self.flush()
+        rows = self.execute("SELECT * FROM entries ORDER BY last_access")
+        return list(Entry(*row) for row in rows)
+
+    def record(
+        self,
+        hashcode: str,
+        query: Optional[str],
+        timestamp: Optional[str],
+        size: int,
+        downloaded: Optional[float] = None,
+        spec: Optional[str] = None,
+        bbox: Optional[Tuple[float, float, float, float]] = None,
+    ) -> None:
+        now = time.time()
+        with self.lock:
+            self.accessed.pop(hashcode, None)
+        west, south, east, north = bbox if bbox is not None else (None,) * 4
+        self.execute(
+            "INSERT OR REPLACE INTO entries (hashcode, query, timestamp, "
+            "downloaded, size, last_access, spec, west, south, east, north) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            hashcode,
+            query,
+            timestamp,
+            downloaded if downloaded is not None else now,
+            size,
+            now,
+            spec,
+            west,
+            south,
+            east,
+            north,
+        )
+
+    def update(self, hashcode: str, **fields) -> None:
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+        self.execute(
+            f"UPDATE entries SET {assignments} WHERE hashcode = ?",
+            *fields.values(),
+            hashcode,
+        )
+
+    def superset(
+        self,
+        spec: str,
+        bbox: Tuple[float, float, float, float],
+        since: Optional[str] = None,
+    ) -> Optional[str]:
+        """The smallest entry of same spec containing the bounding box."""
+        west, south, east, north = bbox
+        rows = self.execute(
+            "SELECT hashcode FROM entries WHERE spec = ? "
+            "AND west <= ? AND south <= ? AND east >= ? AND north >= ? "
+            "AND timestamp >= ? "
+            "ORDER BY (east - west) * (north - south) LIMIT 1",
+            spec,
+            west,
+            south,
+            east,
+            north,
+            since if since is not None else "",
+        )
+        return rows[0][0] if len(rows) > 0 else None
+
+    def touch(self, hashcode: str) -> None:
+        with self.lock:
+            self.accessed[hashcode] = time.time()
+            pending = len(self.accessed)
+        if pending >= self.flush_after:
+            self.flush()
+
+    def remove(self, hashcode: str) -> None:
+        with self.lock:
+            self.accessed.pop(hashcode, None)
+        self.execute("DELETE FROM entries WHERE hashcode = ?", hashcode)
+
+
+class OSMCache(UserDict):
+    """Two-tier cache of Overpass responses.
+
+    Responses are kept in memory in least recently used order, within
+    max_entries and max_bytes (sizes are estimated, again on each access
+    as shapes may have been built meanwhile); they are stored on disk within
+    max_disk_bytes, and removed when not accessed for max_age.
+    None means no limit.
+
+    Entries on disk are listed in a manifest, with the original query and
+    the OSM base timestamp. Hits, misses and evictions are counted in stats.
+    """
+
+    # "columnar" (memory-mapped arrays) or "json"
+    format = "columnar"
+
+    max_entries: Optional[int] = None
+    max_bytes: Optional[int] = None
+
+    max_disk_bytes: Optional[int] = None
+    max_age: Optional[pd.Timedelta] = None
+
+    def __init__(self):
+        self.cachedir = Path(user_cache_dir("cartotools")) / "json"
+        if not self.cachedir.exists():
+            self.cachedir.mkdir(parents=True)
+        self.columnar_dir = Path(user_cache_dir("cartotools")) / "columnar"
+        if not self.columnar_dir.exists():
+            self.columnar_dir.mkdir(parents=True)
+        self.manifest = Manifest(
+            Path(user_cache_dir("cartotools")) / "manifest.sqlite"
+        )
+        self.sync()
+        super().__init__()
+        self.data: OrderedDict = OrderedDict()
+        # sizes of responses in memory, measured when stored
+        self.sizes: Dict[str, int] = dict()
+        self.nbytes = 0
+        self.stats: Counter = Counter()
+        # responses may be requested from several threads
+        self.lock = threading.RLock()
+
+    def path(self, hashcode: str) -> Path:
+        directory = self.columnar_dir / hashcode
+        if directory.exists():
+            return directory
+        return self.cachedir / f"{hashcode}.json"
+
+    def sync(self) -> None:
+        """Align the manifest with the files found on disk."""
+        paths = {
+            p.stem: p
+            for p in chain(
+                self.cachedir.glob("*.json"),
+                (p for p in self.columnar_dir.iterdir() if p.is_dir()),
+            )
+            if not p.name.startswith(".tmp")
+        }
+        known = set(entry.hashcode for entry in self.manifest.entries())
+        for hashcode in known - set(paths):
+            self.manifest.remove(hashcode)
+        for hashcode in set(paths) - known:
+            # the timestamp is only known after parsing, see timestamp()
+            mtime = paths[hashcode].stat().st_mtime
+            self.manifest.record(
+                hashcode, None, None, disk_size(paths[hashcode]), mtime
+            )
+
+    def __getitem__(self, hashcode: str):
+        with self.lock:
+            response = self.data.get(hashcode, None)
+            if response is not None:
+                self.stats["hits"] += 1
+                # shapes may have been built since: measure it again
+                self.store(hashcode, response)
+        if response is None:
+            return self.__missing__(hashcode)
+        self.manifest.touch(hashcode)
+        return response
+
+    def get(self, hashcode: str, default=None):
+        response = self[hashcode]
+        return default if response is None else response
+
+    def __missing__(self, hashcode: str):
+        directory = self.columnar_dir / hashcode
+        filename = self.cachedir / f"{hashcode}.json"
+        if directory.exists():
+            response = read_columnar(directory, hashcode)
+        elif filename.exists():
+            with filename.open("rb") as fh:
+                response = Response.from_stream(
+                    iter(partial(fh.read, chunk_size), b""), hashcode, lazy=True
+                )
+            if self.format == "columnar":  # migrate former JSON files
+                write_columnar(directory, response)
+                filename.unlink()
+        else:
+            self.stats["misses"] += 1
+            return None
+        self.stats["disk_hits"] += 1
+
+        entry = self.manifest.get(hashcode)
+        timestamp = response.header.get("osm3s", {}).get("timestamp_osm_base")
+        if entry is None:
+            self.manifest.record(
+                hashcode, None, timestamp, disk_size(self.path(hashcode))
+            )
+        else:
+            if entry.timestamp is None:
+                self.manifest.update(
+                    hashcode,
+                    timestamp=timestamp,
+                    size=disk_size(self.path(hashcode)),
+                )
+            self.manifest.touch(hashcode)
+
+        # Attention à ne pas réécrire le fichier...
+        self.store(hashcode, response)
+        return response
+
+    def __setitem__(self, hashcode: str, data):
+        self.save(hashcode, data)
+
+    def save(
+        self,
+        hashcode: str,
+        data: Response,
+        query: Optional[str] = None,
+        spec: Optional[str] = None,
+        bbox: Optional[Tuple[float, float, float, float]] = None,
+    ) -> None:
+        """Store a response in memory and on disk.
+
+        spec and bbox describe queries on a bounding box, so that the
+        response may be clipped for queries on a smaller bounding box.
+        """
+        self.store(hashcode, data)
+        if self.format == "columnar":
+            write_columnar(self.columnar_dir / hashcode, data)
+        else:
+            filename = self.cachedir / f"{hashcode}.json"
+            with filename.open("w") as fh:
+                dump(data.header, data.elements(), fh)
+        self.manifest.record(
+            hashcode,
+            query,
+            data.header.get("osm3s", {}).get("timestamp_osm_base"),
+            disk_size(self.path(hashcode)),
+            spec=spec,
+            bbox=bbox,
+        )
+        self.evict_disk(keep=hashcode)
+
+    def timestamp(self, hashcode: str) -> Optional[pd.Timestamp]:
+        """OSM base timestamp of a cached entry, None if not cached."""
+        response = self.data.get(hashcode, None)
+        if response is not None:  # no need to query the manifest
+            timestamp = response.header.get("osm3s", {}).get(
+                "timestamp_osm_base"
+            )
+            if timestamp is not None:
+                return pd.Timestamp(timestamp)
+        entry = self.manifest.get(hashcode)
+        if entry is None:
+            return None
+        if entry.timestamp is None:  # not indexed yet
+            if self.get(hashcode) is None:
+                return None
+            entry = self.manifest.get(hashcode)
+            if entry is None or entry.timestamp is None:
+                return None
+        return pd.Timestamp(entry.timestamp)
+
+    def superset(
+        self,
+        spec: str,
+        bbox: Tuple[float, float, float, float],
+        expiration: Optional[pd.Timedelta] = None,
+    ) -> Optional[Response]:
+        """A cached response of same spec on a larger bounding box."""
+        since = None
+        if expiration is not None:
+            since = (pd.Timestamp("now", tz="utc") - expiration).strftime(
+                "%Y-%m-%dT%H:%M:%SZ"
+            )
+        hashcode = self.manifest.superset(spec, bbox, since)
+        if hashcode is None:
+            return None
+        return self.get(hashcode)
+
+    def __delitem__(self, hashcode: str) -> None:
+        with self.lock:
+            del self.data[hashcode]
+            self.nbytes -= self.sizes.pop(hashcode, 0)
+
+    def store(self, hashcode: str, response: Response) -> None:
+        """Keep a response in memory, evicting the least recently used."""
+        with self.lock:
+            self.nbytes -= self.sizes.pop(hashcode, 0)
+            self.data[hashcode] = response
+            self.data.move_to_end(hashcode)
+            # estimates include elements, and shapes built so far
+            self.sizes[hashcode] = response.nbytes
+            self.nbytes += self.sizes[hashcode]
+            while len(self.data) > 1 and (
+                (
+                    self.max_entries is not None
+                    and len(self.data) > self.max_entries
+                )
+                or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+            ):
+                evicted, _ = self.data.popitem(last=False)
+                self.nbytes -= self.sizes.pop(evicted, 0)
+                self.stats["evictions"] += 1
+
+    def entries(self) -> List[Entry]:
+        """Entries on disk, least recently accessed first."""
+        return self.manifest.entries()
+
+    def disk_usage(self) -> int:
+        return sum(entry.size for entry in self.entries())
+
+    def remove(self, hashcode: str) -> None:
+        """Remove an entry from disk."""
+        path = self.path(hashcode)
+        if path.is_dir():
+            shutil.rmtree(path)
+        elif path.exists():
+            path.unlink()
+        self.manifest.remove(hashcode)
+
+    def evict_disk(self, keep: Optional[str] = None) -> None:
+        """Remove oldest entries from disk, to fit max_disk_bytes/max_age."""
+        if self.max_disk_bytes is None and self.max_age is None:
+            return
+        entries = self.entries()
+        total = sum(entry.size for entry in entries)
+        now = time.time()
+        for entry in entries:
+            too_old = (
+                self.max_age is not None
+                and now - entry.last_access > self.max_age.total_seconds()
+            )
+            too_big = (
+                self.max_disk_bytes is not None and total > self.max_disk_bytes
+            )
+            if entry.hashcode == keep or not (too_old or too_big):
+                continue
+            self.remove(entry.hashcode)
+            total -= entry.size
+            self.stats["disk_evictions"] += 1
@@ -1,8 +1,63 @@
-import time
+import json
+from concurrent import futures
 from functools import lru_cache, partial
-from typing import Tuple
-
-from shapely.ops import transform
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from shapely.geometry import Point, base
+from shapely.ops import transform, unary_union
+from shapely.prepared import prep
+
+try:  # vectorized predicates need shapely >= 2.0
+    import shapely
+except ImportError:
+    shapely = None
+
+
+def union(
+    geometries: Sequence[base.BaseGeometry],
+    bounds: Optional[np.ndarray] = None,
+    max_workers: Optional[int] = None,
+) -> base.BaseGeometry:
+    """Union of many geometries, possibly spread over a process pool.
+
+    unary_union already partitions geometries with a STR-tree. With
+    max_workers, geometries are sorted into vertical strips of their
+    bounds (west, south, east, north), each strip is merged in its own
+    process, then the strips are merged together.
+    """
+    geometries = list(geometries)
+    if max_workers is None or max_workers < 2 or len(geometries) < 1024:
+        return unary_union(geometries)
+
+    if bounds is None:
+        bounds = np.array([g.bounds for g in geometries], dtype=float)
+    x = np.nan_to_num((bounds[:, 0] + bounds[:, 2]) / 2)
+    y = np.nan_to_num((bounds[:, 1] + bounds[:, 3]) / 2)
+    order = np.lexsort((y, x))
+
+    strips: List[List[base.BaseGeometry]] = [
+        [geometries[i] for i in chunk]
+        for chunk in np.array_split(order, max_workers)
+    ]
+    with futures.ProcessPoolExecutor(max_workers) as executor:
+        parts = list(executor.map(unary_union, strips))
+    return unary_union(parts)
+
+
+def contains_xy(
+    geometry: base.BaseGeometry, lon: np.ndarray, lat: np.ndarray
+) -> np.ndarray:
+    """Boolean mask of points (lon, lat) within a geometry."""
+    if shapely is None or not hasattr(shapely, "contains_xy"):
+        prepared = prep(geometry)
+        return np.fromiter(
+            (prepared.contains(Point(x, y)) for x, y in zip(lon, lat)),
+            dtype=bool,
+            count=len(lon),
+        )
+    shapely.prepare(geometry)
+    return shapely.contains_xy(geometry, lon, lat)
 
 
 class ShapelyMixin(object):
@@ -18,6 +73,44 @@ class ShapelyMixin(object):
         west, south, east, north = self.bounds
         return west, east, south, north
 
+    def contains_xy(
+        self,
+        lon: np.ndarray,
+        lat: np.ndarray,
+        chunk_size: int = 1 << 20,
+        max_workers: Optional[int] = None,
+    ) -> np.ndarray:
+        """Boolean mask of points (lon, lat) within the shape.
+
+        Points outside the bounding box are discarded first, others are
+        tested by chunks against the prepared shape, in a process pool if
+        max_workers is set.
+        """
+        shape = np.shape(lon)
+        lon = np.asarray(lon, dtype=float).ravel()
+        lat = np.asarray(lat, dtype=float).ravel()
+        west, south, east, north = self.bounds
+        mask = (lon >= west) & (lon <= east) & (lat >= south) & (lat <= north)
+
+        idx = np.flatnonzero(mask)
+        chunks = [
+            idx[start : start + chunk_size]
+            for start in range(0, len(idx), chunk_size)
+        ]
+        if max_workers is None or max_workers < 2 or len(chunks) < 2:
+            for chunk in chunks:
+                mask[chunk] = contains_xy(self.shape, lon[chunk], lat[chunk])
+        else:
+            with futures.ProcessPoolExecutor(max_workers) as executor:
+                results = executor.map(
+                    partial(contains_xy, self.shape),
+                    (lon[chunk] for chunk in chunks),
+                    (lat[chunk] for chunk in chunks),
+                )
+                for chunk, result in zip(chunks, results):
+                    mask[chunk] = result
+        return mask.reshape(shape)
+
     @property
     def _geom(self):
         # convenient for cascaded_union
@@ -82,29 +175,45 @@ def json_request(url, timeout=180, **kwargs):
     Send a request to the Overpass API via HTTP POST and return the JSON
     response.
 
+    Server overload (429, 504, etc.) is handled by the scheduler, which
+    retries the request after a pause.
+
     Reference: https://github.com/gboeing/osmnx/blob/master/osmnx/core.py
     """
-    from .. import session
+    from ..scheduler import scheduler
 
-    response = session.post(url, timeout=timeout, **kwargs)
+    response = scheduler.request("POST", url, timeout=timeout, **kwargs)
 
     try:
         response_json = response.json()
     except Exception:
-        # 429 is 'too many requests' and 504 is 'gateway timeout' from server
-        # overload - handle these errors by recursively calling
-        # overpass_request until we get a valid response
-        if response.status_code in [429, 504]:
-            # pause for error_pause_duration seconds before re-trying request
-            time.sleep(1)
-            response_json = json_request(url, timeout=timeout, **kwargs)
-
-        # else, this was an unhandled status_code, throw an exception
-        else:
-            raise Exception(
-                "Server returned no JSON data.\n{} {}\n{}".format(
-                    response, response.reason, response.text
-                )
+        raise Exception(
+            "Server returned no JSON data.\n{} {}\n{}".format(
+                response, response.reason, response.text
+            )
+        )
+
+    return response_json
+
+
+async def ajson_request(url, timeout=180, **kwargs):
+    """
+    Asynchronous version of json_request.
+    """
+    from ..scheduler import scheduler
+
+    if "params" in kwargs:  # aiohttp only accepts strings
+        kwargs["params"] = {k: str(v) for k, v in kwargs["params"].items()}
+
+    response = await scheduler.arequest("POST", url, timeout=timeout, **kwargs)
+
+    try:
+        response_json = json.loads(response.content)
+    except Exception:
+        raise Exception(
+            "Server returned no JSON data.\n{}\n{}".format(
+                response.status, response.content.decode(errors="replace")
             )
+        )
 
     return response_json
@@ -0,0 +1,71 @@
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+from xml.etree import ElementTree
+
+__all__ = ["Diff", "parse_adiff"]
+
+
+class Diff(NamedTuple):
+    timestamp: Optional[str]  # new timestamp_osm_base
+    upserts: List[Dict[str, Any]]  # created or modified elements
+    deletes: List[Tuple[str, int]]  # (type, id) of deleted elements
+
+
+def element(elem: ElementTree.Element) -> Dict[str, Any]:
+    """Convert an OSM XML element to its Overpass JSON equivalent."""
+    p: Dict[str, Any] = {"type": elem.tag, "id": int(elem.attrib["id"])}
+    if elem.tag == "node":
+        p["lat"] = float(elem.attrib["lat"])
+        p["lon"] = float(elem.attrib["lon"])
+    elif elem.tag == "way":
+        p["nodes"] = list(int(nd.attrib["ref"]) for nd in elem.iter("nd"))
+    elif elem.tag == "relation":
+        p["members"] = list(
+            {
+                "type": m.attrib["type"],
+                "ref": int(m.attrib["ref"]),
+                "role": m.attrib.get("role", ""),
+            }
+            for m in elem.iter("member")
+        )
+    tags = {t.attrib["k"]: t.attrib["v"] for t in elem.iter("tag")}
+    if len(tags) > 0:
+        p["tags"] = tags
+    return p
+
+
+def parse_adiff(chunks: Iterable[bytes]) -> Diff:
+    """Parse an Overpass augmented diff ([adiff:...] query, XML output).
+
+    The payload is parsed incrementally; only the state after the diff
+    (the <new> part of each action) is kept.
+    """
+    parser = ElementTree.XMLPullParser(events=("start", "end"))
+    stack: List[str] = []
+    action = None
+    diff = Diff(None, [], [])
+
+    def consume():
+        nonlocal action, diff
+        for event, elem in parser.read_events():
+            if event == "start":
+                stack.append(elem.tag)
+                if elem.tag == "action":
+                    action = elem.attrib.get("type")
+                continue
+            stack.pop()
+            if elem.tag == "meta" and diff.timestamp is None:
+                diff = diff._replace(timestamp=elem.attrib.get("osm_base"))
+            elif elem.tag in ["node", "way", "relation"]:
+                if "action" in stack and stack[-1] != "old":
+                    if action == "delete" or elem.get("visible") == "false":
+                        diff.deletes.append((elem.tag, int(elem.attrib["id"])))
+                    else:
+                        diff.upserts.append(element(elem))
+                elem.clear()
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        consume()
+    parser.close()
+    consume()
+    return diff
@@ -0,0 +1,400 @@
+import sys
+from array import array
+from collections.abc import Mapping
+from itertools import chain
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from shapely.geometry import LineString, Polygon, base
+
+try:  # shapely >= 2.0 builds geometries from coordinate arrays in one call
+    from shapely import (
+        get_num_coordinates,
+        linearrings,
+        linestrings,
+        polygons,
+    )
+except ImportError:
+    get_num_coordinates = linearrings = linestrings = polygons = None
+
+__all__ = ["NodeStore", "PackedWays", "Ways"]
+
+# rough memory used by a shape, in Python and GEOS, and by each coordinate
+shape_nbytes = 400
+coordinate_nbytes = 32
+
+
+def elements_nbytes(value: Any) -> int:
+    """Rough memory used by JSON elements (dicts, lists, str, numbers).
+
+    Dictionary keys are not counted, as they are shared by the parser.
+    """
+    nbytes = sys.getsizeof(value)
+    if isinstance(value, dict):
+        return nbytes + sum(map(elements_nbytes, value.values()))
+    if isinstance(value, list):
+        if len(value) > 0 and type(value[0]) is int:  # e.g. node ids
+            return nbytes + len(value) * sys.getsizeof(value[0])
+        return nbytes + sum(map(elements_nbytes, value))
+    return nbytes
+
+
+def shapes_nbytes(shapes: Iterable[base.BaseGeometry]) -> int:
+    """Rough memory used by shapes, including their coordinates in GEOS."""
+    shapes = list(shapes)
+    if get_num_coordinates is not None:
+        coords = int(get_num_coordinates(np.array(shapes, dtype=object)).sum())
+    else:  # shapely < 2.0
+        coords = sum(len(getattr(s, "exterior", s).coords) for s in shapes)
+    return shape_nbytes * len(shapes) + coordinate_nbytes * coords
+
+
+class NodeStore(Mapping):
+    """Compact storage of OSM nodes.
+
+    Ids, longitudes and latitudes are kept in arrays sorted by id. Other
+    attributes (tags, metadata) are only kept for the nodes which have some.
+
+    nodes[id] rebuilds the JSON element as returned by Overpass.
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        lon: np.ndarray,
+        lat: np.ndarray,
+        attributes: Optional[Dict[int, Dict[str, Any]]] = None,
+    ) -> None:
+        self.ids = ids
+        self.lon = lon
+        self.lat = lat
+        self.attributes = attributes if attributes is not None else dict()
+        self._attributes_nbytes: Optional[int] = None
+
+    @classmethod
+    def from_elements(cls, elements: Iterable[Dict[str, Any]]) -> "NodeStore":
+        ids, lon, lat = array("q"), array("d"), array("d")
+        attributes: Dict[int, Dict[str, Any]] = dict()
+        for p in elements:
+            ids.append(p["id"])
+            lon.append(p.get("lon", np.nan))
+            lat.append(p.get("lat", np.nan))
+            if len(p) > 4:
+                attributes[p["id"]] = {
+                    k: v
+                    for k, v in p.items()
+                    if k not in ["type", "id", "lon", "lat"]
+                }
+        # sort by id, drop duplicates
+        ids_, first = np.unique(
+            np.frombuffer(ids, dtype=np.int64), return_index=True
+        )
+        return cls(
+            ids_,
+            np.frombuffer(lon, dtype=np.float64)[first],
+            np.frombuffer(lat, dtype=np.float64)[first],
+            attributes,
+        )
+
+    def index(self, ids: np.ndarray) -> np.ndarray:
+        """Positions of ids in the arrays; KeyError if any is missing."""
+        idx = np.searchsorted(self.ids, ids)
+        found = idx < len(self.ids)
+        found[found] = self.ids[idx[found]] == ids[found]
+        if not found.all():
+            raise KeyError(int(np.asarray(ids)[~found][0]))
+        return idx
+
+    def __getitem__(self, key: int) -> Dict[str, Any]:
+        i = self.index(np.array([key], dtype=np.int64))[0]
+        element = {
+            "type": "node",
+            "id": int(self.ids[i]),
+            "lat": float(self.lat[i]),
+            "lon": float(self.lon[i]),
+        }
+        element.update(self.attributes.get(key, {}))
+        return element
+
+    def __contains__(self, key: object) -> bool:
+        i = np.searchsorted(self.ids, key)
+        return bool(i < len(self.ids) and self.ids[i] == key)
+
+    def __iter__(self) -> Iterator[int]:
+        return (int(key) for key in self.ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        if self._attributes_nbytes is None:
+            self._attributes_nbytes = elements_nbytes(self.attributes)
+        arrays = self.ids.nbytes + self.lon.nbytes + self.lat.nbytes
+        return arrays + self._attributes_nbytes
+
+    def tagged(self) -> Iterator[Dict[str, Any]]:
+        """Iterate on the nodes which come with tags or metadata."""
+        return (self[key] for key in self.attributes)
+
+
+class PackedWays(Mapping):
+    """Compact storage of OSM ways.
+
+    Ids are kept in a sorted array; node ids of all ways are concatenated
+    in one flat array, split by offsets. Other attributes (tags, metadata)
+    are kept in a dictionary.
+
+    ways[id] rebuilds the JSON element as returned by Overpass.
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        offsets: np.ndarray,
+        refs: np.ndarray,
+        attributes: Optional[Dict[int, Dict[str, Any]]] = None,
+    ) -> None:
+        self.ids = ids
+        self.offsets = offsets
+        self.refs = refs
+        self.attributes = attributes if attributes is not None else dict()
+        self._attributes_nbytes: Optional[int] = None
+
+    @classmethod
+    def from_elements(cls, elements: Iterable[Dict[str, Any]]) -> "PackedWays":
+        ways = sorted(elements, key=lambda p: p["id"])
+        lengths = np.fromiter(
+            (len(p["nodes"]) for p in ways), dtype=np.int64, count=len(ways)
+        )
+        return cls(
+            np.fromiter(
+                (p["id"] for p in ways), dtype=np.int64, count=len(ways)
+            ),
+            np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+            np.fromiter(
+                chain.from_iterable(p["nodes"] for p in ways),
+                dtype=np.int64,
+                count=lengths.sum(),
+            ),
+            {
+                p["id"]: {
+                    k: v
+                    for k, v in p.items()
+                    if k not in ["type", "id", "nodes"]
+                }
+                for p in ways
+                if len(p) > 3
+            },
+        )
+
+    def position(self, key: int) -> int:
+        i = int(np.searchsorted(self.ids, key))
+        if i == len(self.ids) or self.ids[i] != key:
+            raise KeyError(key)
+        return i
+
+    def __getitem__(self, key: int) -> Dict[str, Any]:
+        i = self.position(key)
+        element = {
+            "type": "way",
+            "id": int(self.ids[i]),
+            "nodes": self.refs[self.offsets[i] : self.offsets[i + 1]].tolist(),
+        }
+        element.update(self.attributes.get(key, {}))
+        return element
+
+    def __contains__(self, key: object) -> bool:
+        try:
+            self.position(key)  # type: ignore
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self) -> Iterator[int]:
+        return (int(key) for key in self.ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        if self._attributes_nbytes is None:
+            self._attributes_nbytes = elements_nbytes(self.attributes)
+        arrays = self.ids.nbytes + self.offsets.nbytes + self.refs.nbytes
+        return arrays + self._attributes_nbytes
+
+
+def way_geometries(nodes: NodeStore, ways: List[Dict[str, Any]]) -> np.ndarray:
+    """Build the geometries of all ways in one batch.
+
+    Closed ways become Polygons, other ways LineStrings.
+    """
+    lengths = np.fromiter(
+        (len(way["nodes"]) for way in ways), dtype=np.int64, count=len(ways)
+    )
+    refs = np.fromiter(
+        chain.from_iterable(way["nodes"] for way in ways),
+        dtype=np.int64,
+        count=lengths.sum(),
+    )
+
+    # resolve all node ids to their index at once
+    idx = nodes.index(refs)
+
+    coords = np.column_stack([nodes.lon[idx], nodes.lat[idx]])
+    way_index = np.repeat(np.arange(len(ways)), lengths)
+
+    valid = lengths >= 2
+    first = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    last = first + np.maximum(lengths, 1) - 1
+    closed = np.zeros(len(ways), dtype=bool)
+    closed[valid] = np.all(
+        coords[first[valid]] == coords[last[valid]], axis=1
+    ) & (lengths[valid] >= 4)
+
+    geometries = np.empty(len(ways), dtype=object)
+    geometries[~valid] = [LineString() for _ in range((~valid).sum())]
+
+    if linestrings is None:  # shapely < 2.0
+        for i in np.flatnonzero(valid):
+            xy = coords[first[i] : last[i] + 1]
+            geometries[i] = Polygon(xy) if closed[i] else LineString(xy)
+        return geometries
+
+    def batch(mask: np.ndarray, function):
+        # renumber the selected ways so that indices are contiguous
+        rank = np.cumsum(mask) - 1
+        selected = mask[way_index]
+        return function(coords[selected], indices=rank[way_index[selected]])
+
+    if (valid & ~closed).any():
+        geometries[valid & ~closed] = batch(valid & ~closed, linestrings)
+    if closed.any():
+        geometries[closed] = polygons(batch(closed, linearrings))
+
+    return geometries
+
+
+class Ways(Mapping):
+    """Mapping of way ids to (meta, shape) tuples.
+
+    Shapes are built the first time they are accessed, then kept.
+    """
+
+    # shapes built one by one before building all remaining ones at once
+    batch_after = 64
+
+    def __init__(self, nodes: NodeStore, meta: Mapping) -> None:
+        self.nodes = nodes
+        self.meta = meta
+        self.shapes: Dict[int, base.BaseGeometry] = {}
+        self._packed: Optional[PackedWays] = None
+        self._bounds: Optional[np.ndarray] = None
+        self._misses = 0
+        self._meta_nbytes: Optional[int] = None
+        # number of shapes measured, and their size
+        self._shapes_nbytes: Tuple[int, int] = (0, 0)
+
+    def __getitem__(self, key: int) -> Tuple[Dict, base.BaseGeometry]:
+        meta = self.meta[key]
+        shape = self.shapes.get(key, None)
+        if shape is None and self._misses >= self.batch_after:
+            # ways are being iterated over: build all others at once
+            self.materialize()
+            shape = self.shapes[key]
+        elif shape is None:
+            # a lone way is faster to build without the batch machinery
+            self._misses += 1
+            refs = np.asarray(meta["nodes"], dtype=np.int64)
+            idx = self.nodes.index(refs)
+            xy = np.column_stack([self.nodes.lon[idx], self.nodes.lat[idx]])
+            if len(xy) < 2:
+                shape = LineString()
+            elif len(xy) >= 4 and (xy[0] == xy[-1]).all():
+                shape = Polygon(xy)
+            else:
+                shape = LineString(xy)
+            self.shapes[key] = shape
+        return meta, shape
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.meta
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.meta)
+
+    def __len__(self) -> int:
+        return len(self.meta)
+
+    @property
+    def nbytes(self) -> int:
+        """Rough estimate of the memory used by elements and shapes.
+
+        Elements are measured once; shapes again when more are built.
+        """
+        if self._meta_nbytes is None:
+            if isinstance(self.meta, PackedWays):
+                self._meta_nbytes = self.meta.nbytes
+            else:
+                self._meta_nbytes = elements_nbytes(list(self.meta.values()))
+        if self._shapes_nbytes[0] != len(self.shapes):
+            self._shapes_nbytes = (
+                len(self.shapes),
+                shapes_nbytes(self.shapes.values()),
+            )
+        nbytes = self._meta_nbytes + self._shapes_nbytes[1]
+        if self._packed is not None:  # attributes are shared with meta
+            packed = self._packed
+            nbytes += packed.ids.nbytes + packed.offsets.nbytes
+            nbytes += packed.refs.nbytes
+        if self._bounds is not None:
+            nbytes += self._bounds.nbytes
+        return nbytes
+
+    def packed(self) -> PackedWays:
+        """The ways as arrays, sorted by id."""
+        if isinstance(self.meta, PackedWays):
+            return self.meta
+        if self._packed is None:
+            self._packed = PackedWays.from_elements(self.meta.values())
+        return self._packed
+
+    def bounds(self) -> np.ndarray:
+        """Bounds (west, south, east, north) of each way, computed on nodes.
+
+        Rows follow the order of packed().ids.
+        """
+        if self._bounds is None:
+            packed = self.packed()
+            idx = self.nodes.index(packed.refs)
+            starts = packed.offsets[:-1]
+            # reduceat needs strictly increasing indices: skip empty ways
+            valid = packed.offsets[1:] > starts
+            bounds = np.full((len(starts), 4), np.nan)
+            if valid.any():
+                lon, lat = self.nodes.lon[idx], self.nodes.lat[idx]
+                bounds[valid, 0] = np.minimum.reduceat(lon, starts[valid])
+                bounds[valid, 1] = np.minimum.reduceat(lat, starts[valid])
+                bounds[valid, 2] = np.maximum.reduceat(lon, starts[valid])
+                bounds[valid, 3] = np.maximum.reduceat(lat, starts[valid])
+            self._bounds = bounds
+        return self._bounds
+
+    def materialize(self, keys: Optional[Iterable[int]] = None) -> None:
+        """Build in one batch the shapes which are not built yet."""
+        if keys is None:
+            keys = self.meta.keys()
+        missing = [self.meta[key] for key in keys if key not in self.shapes]
+        if len(missing) == 0:
+            return
+        shapes = way_geometries(self.nodes, missing)
+        self.shapes.update(zip((p["id"] for p in missing), shapes))
+
+    def items(self):
+        self.materialize()
+        return super().items()
+
+    def values(self):
+        self.materialize()
+        return super().values()
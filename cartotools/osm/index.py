@@ -0,0 +1,69 @@
+from collections import defaultdict
+from typing import Any, Dict, Iterable, Set
+
+__all__ = ["TagIndex"]
+
+
+class TagIndex(object):
+    """Inverted index of OSM tags.
+
+    Elements are indexed by type, then by tag key and tag value:
+    index[type][key][value] is the set of ids of matching elements.
+
+    Conditions on a tag key may be:
+    - None (or True) to test for the presence of the key;
+    - a string (or any other value) for an exact match on the value;
+    - a compiled regular expression, searched in values;
+    - a list, tuple or set of strings matching any of them.
+    """
+
+    def __init__(self, elements: Iterable[Dict[str, Any]]) -> None:
+        self.index: Dict[str, Dict[str, Dict[str, Set[int]]]] = defaultdict(
+            lambda: defaultdict(lambda: defaultdict(set))
+        )
+        for p in elements:
+            for key, value in p.get("tags", {}).items():
+                self.index[p["type"]][key][value].add(p["id"])
+
+    def keys(self, element: str) -> Set[str]:
+        return set(self.index.get(element, {}).keys())
+
+    def values(self, element: str, key: str) -> Set[str]:
+        return set(self.index.get(element, {}).get(key, {}).keys())
+
+    def match(self, element: str, key: str, value: Any = None) -> Set[int]:
+        values = self.index.get(element, {}).get(key, {})
+        if value is None or value is True:
+            return set().union(*values.values())
+        if hasattr(value, "search"):  # compiled regular expression
+            return set().union(
+                *(ids for v, ids in values.items() if value.search(v))
+            )
+        if isinstance(value, (list, tuple, set, frozenset)):
+            return set().union(*(values.get(v, ()) for v in value))
+        # values are strings: other types never match, as with ==
+        return set(values.get(value, ()))
+
+    def select(
+        self, element: str, how: str = "all", **conditions: Any
+    ) -> Set[int]:
+        """Ids of elements matching all (or any) of the conditions."""
+        if how not in ["all", "any"]:
+            raise ValueError("how must be 'all' or 'any'")
+        matches = sorted(
+            (
+                self.match(element, key, value)
+                for key, value in conditions.items()
+            ),
+            key=len,
+        )
+        if len(matches) == 0:
+            return set()
+        if how == "any":
+            return set().union(*matches)
+        result = matches[0]
+        for ids in matches[1:]:
+            if len(result) == 0:
+                break
+            result = result & ids
+        return result
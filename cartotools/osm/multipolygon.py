@@ -0,0 +1,151 @@
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Mapping, Sequence
+
+import numpy as np
+from shapely.geometry import LinearRing, MultiPolygon, Polygon, base
+from shapely.prepared import prep
+
+from .elements import NodeStore
+
+try:  # shapely >= 2.0 builds geometries from coordinate arrays in one call
+    from shapely import linearrings, make_valid
+except ImportError:
+    linearrings = make_valid = None
+
+__all__ = ["assemble_rings", "relation_geometries"]
+
+# relations describing areas with outer and inner ways
+area_types = {"multipolygon", "boundary"}
+
+
+def assemble_rings(segments: Sequence[Sequence[int]]) -> List[List[int]]:
+    """Stitch sequences of node ids into closed rings.
+
+    Segments are joined on their end nodes, found in a dictionary rather
+    than by comparing all pairs; segments which cannot be closed into a
+    ring are dropped.
+    """
+    rings: List[List[int]] = []
+    open_: List[Sequence[int]] = []
+    for segment in segments:
+        if len(segment) >= 4 and segment[0] == segment[-1]:
+            rings.append(list(segment))
+        elif len(segment) >= 2:
+            open_.append(segment)
+
+    ends: Dict[int, List[int]] = defaultdict(list)
+    for i, segment in enumerate(open_):
+        ends[segment[0]].append(i)
+        ends[segment[-1]].append(i)
+
+    used = [False] * len(open_)
+    for i, segment in enumerate(open_):
+        if used[i]:
+            continue
+        used[i] = True
+        ring = list(segment)
+        while ring[0] != ring[-1]:
+            tail = ring[-1]
+            j = next((j for j in ends[tail] if not used[j]), None)
+            if j is None:
+                break
+            used[j] = True
+            following = open_[j]
+            if following[0] == tail:
+                ring.extend(following[1:])
+            else:
+                ring.extend(following[-2::-1])
+        if ring[0] == ring[-1] and len(ring) >= 4:
+            rings.append(ring)
+
+    return rings
+
+
+def rings_to_polygon(
+    outers: List[base.BaseGeometry], inners: List[base.BaseGeometry]
+) -> base.BaseGeometry:
+    """Assign inner rings to the outer ring containing them."""
+    holes: List[List[base.BaseGeometry]] = [[] for _ in outers]
+    prepared = [prep(Polygon(outer)) for outer in outers]
+    for inner in inners:
+        point = Polygon(inner).representative_point()
+        for i, p in enumerate(prepared):
+            if len(outers) == 1 or p.contains(point):
+                holes[i].append(inner)
+                break
+
+    polygons = [Polygon(outer, h) for outer, h in zip(outers, holes)]
+    result = polygons[0] if len(polygons) == 1 else MultiPolygon(polygons)
+    if not result.is_valid:
+        result = make_valid(result) if make_valid else result.buffer(0)
+    return result
+
+
+def relation_geometries(
+    nodes: NodeStore,
+    ways: Mapping[int, Dict[str, Any]],
+    relations: Iterable[Dict[str, Any]],
+) -> Dict[int, base.BaseGeometry]:
+    """(Multi)Polygons of multipolygon and boundary relations.
+
+    Relations with missing ways or nodes are skipped; rings which cannot
+    be closed are dropped. All rings are built in one batch.
+    """
+    # node ids of all rings, with their relation and role
+    rings: List[List[int]] = []
+    owners: List[int] = []
+    inner: List[bool] = []
+
+    for rel in relations:
+        if rel.get("tags", {}).get("type", None) not in area_types:
+            continue
+        members = [m for m in rel.get("members", []) if m["type"] == "way"]
+        if any(m["ref"] not in ways for m in members):
+            continue
+        for role in ["outer", "inner"]:
+            segments = [
+                ways[m["ref"]]["nodes"]
+                for m in members
+                if (m.get("role", "") == "inner") == (role == "inner")
+            ]
+            closed = assemble_rings(segments)
+            rings.extend(closed)
+            owners.extend([rel["id"]] * len(closed))
+            inner.extend([role == "inner"] * len(closed))
+
+    if len(rings) == 0 or len(nodes) == 0:
+        return dict()
+
+    lengths = np.fromiter((len(r) for r in rings), dtype=np.int64)
+    refs = np.fromiter(
+        (ref for r in rings for ref in r), dtype=np.int64, count=lengths.sum()
+    )
+    ring_index = np.repeat(np.arange(len(rings)), lengths)
+
+    # skip relations with nodes missing in the response
+    idx = np.searchsorted(nodes.ids, refs)
+    found = idx < len(nodes.ids)
+    found[found] = nodes.ids[idx[found]] == refs[found]
+    missing = set(np.asarray(owners)[ring_index[~found]].tolist())
+    idx[~found] = 0
+
+    coords = np.column_stack([nodes.lon[idx], nodes.lat[idx]])
+    if linearrings is not None:
+        shapes = linearrings(coords, indices=ring_index)
+    else:  # shapely < 2.0
+        splits = np.cumsum(lengths)[:-1]
+        shapes = [LinearRing(xy) for xy in np.split(coords, splits)]
+
+    outers: Dict[int, List[base.BaseGeometry]] = defaultdict(list)
+    inners: Dict[int, List[base.BaseGeometry]] = defaultdict(list)
+    for owner, is_inner, shape in zip(owners, inner, shapes):
+        if owner in missing:
+            continue
+        (inners if is_inner else outers)[owner].append(shape)
+
+    result: Dict[int, base.BaseGeometry] = dict()
+    for key, outer in outers.items():
+        geometry = rings_to_polygon(outer, inners[key])
+        if not geometry.is_empty:
+            result[key] = geometry
+    return result
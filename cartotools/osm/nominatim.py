@@ -1,9 +1,29 @@
+import json
+import logging
+import sqlite3
+import time
+import zlib
 from collections import OrderedDict, UserDict
-from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Union
+from concurrent import futures
+from contextlib import closing
+from pathlib import Path
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
 
+import pandas as pd
+from appdirs import user_cache_dir
 from shapely.geometry import base, shape
 
-from .core import ShapelyMixin, json_request
+from .core import ShapelyMixin, ajson_request, json_request
 
 __all__ = ["location"]
 
@@ -18,7 +38,7 @@ class BoundingBox(NamedTuple):
 LocationType = Union[int, str, Iterable, "Nominatim"]
 
 
-def nominatim_request(query: str, **kwargs):
+def nominatim_params(query: str) -> Dict:
 
     params: Dict = OrderedDict()
 
@@ -36,14 +56,38 @@ def nominatim_request(query: str, **kwargs):
         for key in sorted(list(query.keys())):
             params[key] = query[key]
 
-    url = "https://nominatim.openstreetmap.org/search"
-    return json_request(url, timeout=30, params=params, **kwargs)
+    return params
+
+
+nominatim_url = "https://nominatim.openstreetmap.org/search"
+
+
+def nominatim_request(query: str, **kwargs):
+    params = nominatim_params(query)
+    return json_request(nominatim_url, timeout=30, params=params, **kwargs)
+
+
+async def anominatim_request(query: str, **kwargs):
+    params = nominatim_params(query)
+    return await ajson_request(
+        nominatim_url, timeout=30, params=params, **kwargs
+    )
 
 
 class Nominatim(ShapelyMixin):
     def __init__(self, name: str, **kwargs) -> None:
 
         results: List[Dict] = nominatim_request(name, **kwargs)
+        self._load(name, results)
+
+    @classmethod
+    def from_results(cls, name: str, results: List[Dict]) -> "Nominatim":
+        """Build from the JSON results of a Nominatim request."""
+        nominatim = cls.__new__(cls)
+        nominatim._load(name, results)
+        return nominatim
+
+    def _load(self, name: str, results: List[Dict]) -> None:
 
         if len(results) == 0:
             raise ValueError(f"No '{name}' found on OpenStreetMap")
@@ -78,15 +122,106 @@ class Nominatim(ShapelyMixin):
         return None
 
 
+class GeocodingCache(object):
+    """SQLite store of Nominatim results, compressed JSON.
+
+    Entries are keyed on the normalized query and the request arguments;
+    they expire after max_age (None means never).
+    """
+
+    max_age: Optional[pd.Timedelta] = None
+
+    def __init__(self, filename: Path) -> None:
+        self.filename = filename
+        self.execute("PRAGMA journal_mode=WAL")
+        self.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, content BLOB, downloaded REAL)"
+        )
+
+    def execute(self, sql: str, *args) -> List:
+        with closing(sqlite3.connect(str(self.filename), timeout=30)) as conn:
+            with conn:
+                return conn.execute(sql, args).fetchall()
+
+    @staticmethod
+    def key(query: str, kwargs: Dict) -> str:
+        if isinstance(query, str):
+            query = " ".join(query.lower().split())
+        return json.dumps(
+            [nominatim_params(query), kwargs], sort_keys=True, default=str
+        )
+
+    def get(self, query: str, kwargs: Dict) -> Optional[List[Dict]]:
+        since = 0.0
+        if self.max_age is not None:
+            since = time.time() - self.max_age.total_seconds()
+        rows = self.execute(
+            "SELECT content FROM results WHERE key = ? AND downloaded >= ?",
+            self.key(query, kwargs),
+            since,
+        )
+        if len(rows) == 0:
+            return None
+        return json.loads(zlib.decompress(rows[0][0]))
+
+    def save(self, query: str, kwargs: Dict, results: List[Dict]) -> None:
+        content = zlib.compress(json.dumps(results).encode())
+        self.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+            self.key(query, kwargs),
+            content,
+            time.time(),
+        )
+
+    def clear(self) -> None:
+        self.execute("DELETE FROM results")
+        self.execute("VACUUM")
+
+
 class CachedRequests(UserDict):
+    """Nominatim results, cached in memory and on disk.
+
+    Set persistent to False to skip the cache on disk.
+    """
 
     kwargs: Dict = dict()
+    persistent: bool = True
+
+    # concurrent requests in many(), throttled by the scheduler anyway
+    max_workers = 4
+
+    def __init__(self) -> None:
+        super().__init__()
+        cachedir = Path(user_cache_dir("cartotools"))
+        if not cachedir.exists():
+            cachedir.mkdir(parents=True)
+        self.cache = GeocodingCache(cachedir / "nominatim.sqlite")
+
+    def cached(self, name: str) -> Optional[Nominatim]:
+        """Result from memory or disk, None if a request is necessary."""
+        for key in [name, name.lower()]:
+            if key in self.data:
+                return self.data[key]
+        if not self.persistent:
+            return None
+        results = self.cache.get(name, self.kwargs)
+        if results is None:
+            return None
+        result = Nominatim.from_results(name, results)
+        self[name.lower()] = result
+        return result
 
     def __missing__(self, name: str) -> Nominatim:
         lower = name.lower()
         if lower in self:
             return self[lower]
-        result = Nominatim(name, **self.kwargs)
+        results = self.cache.get(name, self.kwargs) if self.persistent else None
+        if results is None:
+            results = nominatim_request(name, **self.kwargs)
+            if self.persistent and len(results) > 0:
+                self.cache.save(name, self.kwargs, results)
+        result = Nominatim.from_results(name, results)
         self[lower] = result
         return result
 
@@ -94,6 +229,98 @@ class CachedRequests(UserDict):
     def __call__(self, name: str) -> Nominatim:
         return self[name]
 
+    def many(
+        self,
+        names: Iterable[str],
+        ordered: bool = True,
+        max_workers: Optional[int] = None,
+    ) -> Iterator[Tuple[str, Union[Nominatim, Exception]]]:
+        """Geocode many names, yield (name, result) pairs.
+
+        Names are deduplicated regardless of case. Cached results come
+        first when ordered is False, then others as requests complete.
+        Failures are yielded as exceptions, instead of raised.
+        """
+        if max_workers is None:
+            max_workers = self.max_workers
+
+        names = list(names)
+        unique: Dict[str, str] = OrderedDict()
+        for name in names:
+            unique.setdefault(name.lower(), name)
+
+        results: Dict[str, Union[Nominatim, Exception]] = dict()
+        for lower, name in unique.items():
+            try:
+                result = self.cached(name)
+            except Exception as e:
+                result = e
+            if result is not None:
+                results[lower] = result
+
+        def pairs(lower: str) -> Iterator[Tuple[str, Any]]:
+            return (
+                (name, results[lower])
+                for name in names
+                if name.lower() == lower
+            )
+
+        if not ordered:
+            for lower in list(results):
+                yield from pairs(lower)
+
+        executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+        todo = {
+            executor.submit(self.__missing__, name): lower
+            for lower, name in unique.items()
+            if lower not in results
+        }
+        try:
+            if ordered:
+                pending = {lower: future for future, lower in todo.items()}
+                for name in names:
+                    lower = name.lower()
+                    if lower not in results:
+                        try:
+                            results[lower] = pending[lower].result()
+                        except Exception as e:
+                            logging.warning(f"Failed to geocode {name}: {e}")
+                            results[lower] = e
+                    yield name, results[lower]
+                return
+            for future in futures.as_completed(todo):
+                lower = todo[future]
+                try:
+                    results[lower] = future.result()
+                except Exception as e:
+                    logging.warning(f"Failed to geocode {lower}: {e}")
+                    results[lower] = e
+                yield from pairs(lower)
+        finally:
+            # do not wait for queued requests if iteration stops early
+            for future in todo:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    async def aget(self, name: str) -> Nominatim:
+        """Asynchronous version of location(name)."""
+        from .. import aio
+
+        lower = name.lower()
+        for key in [name, lower]:
+            if key in self:
+                return self.data[key]
+        results = None
+        if self.persistent:
+            results = await aio.run(self.cache.get, name, self.kwargs)
+        if results is None:
+            results = await anominatim_request(name, **self.kwargs)
+            if self.persistent and len(results) > 0:
+                await aio.run(self.cache.save, name, self.kwargs, results)
+        result = Nominatim.from_results(name, results)
+        self[lower] = result
+        return result
+
 
 location = CachedRequests()
 location._ipython_key_completions_ = location.keys()  # type: ignore
@@ -1,128 +1,22 @@
 import hashlib
-import json
 import logging
 import requests
-from collections import UserDict
-from pathlib import Path
-from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from concurrent import futures
+from typing import Dict, Iterable, Optional, Tuple
+from xml.etree.ElementTree import ParseError
 
+import numpy as np
 import pandas as pd
-from appdirs import user_cache_dir
-from shapely.geometry import LineString, Point, Polygon, base
-from shapely.ops import cascaded_union
 
-from .core import ShapelyMixin
+from .cache import OSMCache
+from .diff import parse_adiff
 from .nominatim import LocationType, Nominatim, location
+from .response import Response
+from .stream import chunk_size
 
 __all__ = ["request"]
 
 
-class Response(ShapelyMixin):
-    def __init__(self, response: Dict[str, Any], name: str) -> None:
-
-        self.response = response
-
-        self.nodes = {
-            p["id"]: p for p in self.response["elements"] if p["type"] == "node"
-        }
-
-        self.ways = {
-            p["id"]: (
-                p,
-                LineString(
-                    list((self.nodes[node]["lon"], self.nodes[node]["lat"]))
-                    for node in p["nodes"]
-                ),
-            )
-            for p in self.response["elements"]
-            if p["type"] == "way"
-        }
-
-        # TODO improve
-        self.ways = {
-            key: (value, (Polygon(shape) if shape.is_closed else shape))
-            for (key, (value, shape)) in self.ways.items()
-        }
-
-        self.relations = {
-            p["id"]: p
-            for p in self.response["elements"]
-            if p["type"] == "relation"
-        }
-
-        self.areas = {
-            p["id"]: p for p in self.response["elements"] if p["type"] == "area"
-        }
-
-        self.display_name: str = name  # TODO improve
-
-    @property
-    def shape(self) -> base.BaseGeometry:
-        return cascaded_union(list(self))
-
-    def __iter__(self):
-        if len(self.ways) > 0:
-            for p in self.ways.values():
-                yield p[1]
-            return
-        for p in self.nodes.values():
-            yield Point(p["lon"], p["lat"])
-
-    def subset(
-        self, **kwargs
-    ) -> Iterator[Tuple[str, Tuple[Dict, base.BaseGeometry]]]:
-        for key, (meta, shape) in self.ways.items():
-            for k, v in kwargs.items():
-                if k in meta["tags"] and meta["tags"][k] == v:
-                    yield key, (meta, shape)
-
-    def keys(self) -> Set[str]:
-        keys = set()
-        for meta, _shape in self.ways.values():
-            for key in meta["tags"].keys():
-                keys.add(key)
-        return keys
-
-    def values(self, key: str) -> Set[str]:
-        values = set()
-        for meta, _shape in self.ways.values():
-            for key_ in meta["tags"].keys():
-                if key_ == key:
-                    values.add(meta["tags"][key_])
-        return values
-
-    @property
-    def related(self) -> Dict[int, List[Dict]]:
-        return {
-            key: list(
-                elt for elt in rel["members"] if elt["type"] == "relation"
-            )
-            for key, rel in self.relations.items()
-        }
-
-
-class OSMCache(UserDict):
-    def __init__(self):
-        self.cachedir = Path(user_cache_dir("cartotools")) / "json"
-        if not self.cachedir.exists():
-            self.cachedir.mkdir(parents=True)
-        super().__init__()
-
-    def __missing__(self, hashcode: str):
-        filename = self.cachedir / f"{hashcode}.json"
-        if filename.exists():
-            response = Response(json.loads(filename.read_text()), hashcode)
-            # Attention à ne pas réécrire le fichier...
-            super().__setitem__(hashcode, response)
-            return response
-
-    def __setitem__(self, hashcode: str, data):
-        super().__setitem__(hashcode, data)
-        filename = self.cachedir / f"{hashcode}.json"
-        with filename.open("w") as fh:
-            fh.write(json.dumps(data.response))
-
-
 class Overpass(object):
 
     pattern = (
@@ -137,6 +31,16 @@ class Overpass(object):
 
     cache_expiration = pd.Timedelta("3650 days")  # infinity?
 
+    # parse responses while downloading them
+    stream = True
+
+    # refresh expired cache entries with augmented diffs
+    incremental = True
+
+    # tiled requests: size of tiles (in degrees), concurrent downloads
+    tile_size = 0.25
+    max_workers = 4
+
     def get_query(self, format_: str, **kwargs) -> str:
 
         if "maxsize" not in kwargs:
@@ -150,32 +54,37 @@ class Overpass(object):
 
         return query_str
 
-    def json_request(
-        self,
-        query_type: str,
-        where: Optional[LocationType] = None,
-        requests_extra: Optional[Dict[str, str]] = None,
-        **kwargs,
-    ) -> Response:
-        if requests_extra is None:
-            requests_extra = dict()
+    def build_query(
+        self, query_type: str, where: Optional[LocationType] = None, **kwargs
+    ) -> Tuple[str, Optional[str], Optional[Tuple[float, ...]]]:
+        """The query string, with its spec and bounding box, if any.
 
-        if isinstance(where, str):
-            where = location(where)
+        The spec is the query without its bounding box.
+        """
+        bbox: Optional[Tuple[float, ...]] = None
+        within = ""
         if isinstance(where, int):  # osm_id
             within = "({})".format(where)
         elif isinstance(where, Nominatim):
-            pattern = "({south:.8f},{west:.8f},{north:.8f},{east:.8f})"
-            within = pattern.format(**where.bbox._asdict())
+            bbox = (
+                where.bbox.west,
+                where.bbox.south,
+                where.bbox.east,
+                where.bbox.north,
+            )
         elif isinstance(where, Iterable):
+            bbox = tuple(where)  # bounds order seems more natural
+
+        if bbox is not None:
+            # the same rounding for the query and for the cache manifest
+            west, south, east, north = (round(float(x), 8) for x in bbox)
+            bbox = west, south, east, north
             pattern = "({:.8f},{:.8f},{:.8f},{:.8f})"
-            west, south, east, north = where  # bounds order seems more natural
             within = pattern.format(south, west, north, east)
-        else:
-            within = ""
 
         filters = ""
-        for key, value in kwargs.items():
+        # sorted, so that the same filters always yield the same query
+        for key, value in sorted(kwargs.items()):
             if value is None:
                 filters += '["{}"]'.format(key)
             else:
@@ -189,29 +98,198 @@ class Overpass(object):
             within=within,
         )
 
-        return self.query(query_str)
+        if bbox is None:
+            return query_str, None, None
+
+        spec = self.get_query(
+            "json", meta="", query_type=query_type, filters=filters, within=""
+        )
+        return query_str, spec, bbox
+
+    def clip_from_cache(
+        self, query_str: str, spec: str, bbox: Tuple[float, ...]
+    ) -> Optional[Response]:
+        """Clip a cached response on a larger bounding box, if any."""
+        if self.fresh(self.cache.timestamp(self.hashcode(query_str))):
+            return None
+        superset = self.cache.superset(spec, bbox, self.cache_expiration)
+        if superset is None:
+            return None
+        logging.info(f"Footprint clipped from cache: {superset.display_name}")
+        return superset.clip(bbox)
+
+    def json_request(
+        self,
+        query_type: str,
+        where: Optional[LocationType] = None,
+        requests_extra: Optional[Dict[str, str]] = None,
+        **kwargs,
+    ) -> Response:
+        if requests_extra is None:
+            requests_extra = dict()
+
+        if isinstance(where, str):
+            where = location(where)
+
+        query_str, spec, bbox = self.build_query(query_type, where, **kwargs)
+
+        if spec is not None and bbox is not None:
+            response = self.clip_from_cache(query_str, spec, bbox)
+            if response is not None:
+                return response
+
+        return self.query(query_str, requests_extra, spec=spec, bbox=bbox)
+
+    async def ajson_request(
+        self,
+        query_type: str,
+        where: Optional[LocationType] = None,
+        requests_extra: Optional[Dict[str, str]] = None,
+        **kwargs,
+    ) -> Response:
+        """Asynchronous version of json_request."""
+        from .. import aio
+
+        if isinstance(where, str):
+            where = await location.aget(where)
+
+        query_str, spec, bbox = self.build_query(query_type, where, **kwargs)
+
+        if spec is not None and bbox is not None:
+            response = await aio.run(
+                self.clip_from_cache, query_str, spec, bbox
+            )
+            if response is not None:
+                return response
+
+        return await self.aquery(query_str, requests_extra, spec, bbox)
+
+    def tiled_request(
+        self,
+        query_type: str,
+        where: LocationType,
+        tile_size: Optional[float] = None,
+        max_workers: Optional[int] = None,
+        **kwargs,
+    ) -> Response:
+        """Split a large bounding box in tiles, fetched concurrently.
+
+        Each tile is cached on its own, so that after a failure, only
+        missing tiles are downloaded again. Results are merged into one
+        Response.
+        """
+        if tile_size is None:
+            tile_size = self.tile_size
+        if max_workers is None:
+            max_workers = self.max_workers
+
+        if isinstance(where, str):
+            where = location(where)
+        if isinstance(where, Nominatim):
+            west, south, east, north = (
+                where.bbox.west,
+                where.bbox.south,
+                where.bbox.east,
+                where.bbox.north,
+            )
+        elif isinstance(where, Iterable):
+            west, south, east, north = where
+        else:
+            raise ValueError("A bounding box is necessary for tiled requests")
+
+        nx = max(1, int(np.ceil((east - west) / tile_size)))
+        ny = max(1, int(np.ceil((north - south) / tile_size)))
+        xs = np.linspace(west, east, nx + 1).tolist()
+        ys = np.linspace(south, north, ny + 1).tolist()
+        tiles = list(
+            (xs[i], ys[j], xs[i + 1], ys[j + 1])
+            for i in range(nx)
+            for j in range(ny)
+        )
+
+        responses = []
+        errors = []
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            todo = {
+                executor.submit(
+                    self.json_request, query_type, where=tile, **kwargs
+                ): tile
+                for tile in tiles
+            }
+            for future in futures.as_completed(todo):
+                try:
+                    responses.append(future.result())
+                except Exception as e:
+                    logging.warning(f"Failed to fetch tile {todo[future]}: {e}")
+                    errors.append(e)
+
+        if len(errors) > 0:
+            # successful tiles are in cache, a new call fetches the others
+            raise errors[0]
+
+        logging.info(f"Merging {len(responses)} tiles")
+        return Response.merge(responses, f"{query_type}{kwargs}")
+
+    def hashcode(self, query_str: str) -> str:
+        return hashlib.md5(query_str.encode("utf-8")).hexdigest()
+
+    def fresh(self, timestamp: Optional[pd.Timestamp]) -> bool:
+        if timestamp is None:
+            return False
+        delta = pd.Timestamp("now", tz="utc") - timestamp
+        return delta <= self.cache_expiration
 
     def query(
-        self, query_str: str, requests_extra: Optional[Dict[str, str]] = None
+        self,
+        query_str: str,
+        requests_extra: Optional[Dict[str, str]] = None,
+        spec: Optional[str] = None,
+        bbox: Optional[Tuple[float, float, float, float]] = None,
+    ) -> Response:
+        """Send a query, or load its response from cache.
+
+        Concurrent calls with the same query share a single download.
+        """
+        from ..singleflight import flights
+
+        return flights.do(
+            "overpass",
+            self.hashcode(query_str),
+            self._query,
+            query_str,
+            requests_extra,
+            spec,
+            bbox,
+        )
+
+    def _query(
+        self,
+        query_str: str,
+        requests_extra: Optional[Dict[str, str]] = None,
+        spec: Optional[str] = None,
+        bbox: Optional[Tuple[float, float, float, float]] = None,
     ) -> Response:
 
-        from .. import session
+        from ..scheduler import scheduler
 
         if requests_extra is None:
             requests_extra = dict()
 
-        hashcode = hashlib.md5(query_str.encode("utf-8")).hexdigest()
-        response = self.cache.get(hashcode, None)
-        if response is not None:
-            last_modification = pd.Timestamp(
-                response.response["osm3s"]["timestamp_osm_base"]
-            )
-            delta = pd.Timestamp("now", tz="utc") - last_modification
-            if delta <= self.cache_expiration:
+        hashcode = self.hashcode(query_str)
+        # freshness is checked on the manifest, before loading anything
+        last_modification = self.cache.timestamp(hashcode)
+        if self.fresh(last_modification):
+            response = self.cache.get(hashcode)
+            if response is not None:
                 logging.info(
                     f"Footprint loaded from cache: {last_modification}"
                 )
                 return response
+        elif last_modification is not None:
+            if self.incremental:
+                response = self.refresh(query_str, requests_extra)
+                if response is not None:
+                    return response
             logging.warning(
                 "Expired cache files. Downloading now from OpenStreetMap."
             )
@@ -220,19 +298,162 @@ class Overpass(object):
             logging.info(
                 f"Sending the following request: {query_str} to {self.url}"
             )
-            response = session.post(
-                url=self.url, data=query_str, **requests_extra
-            )
-            response = Response(response.json(), hashcode)
-            self.cache[hashcode] = response
+            if self.stream:
+                response = scheduler.request(
+                    "POST",
+                    self.url,
+                    data=query_str,
+                    stream=True,
+                    **requests_extra,
+                )
+                response = Response.from_stream(
+                    response.iter_content(chunk_size), hashcode, lazy=True
+                )
+            else:
+                response = scheduler.request(
+                    "POST", self.url, data=query_str, **requests_extra
+                )
+                response = Response(response.json(), hashcode, lazy=True)
+            self.cache.save(hashcode, response, query_str, spec, bbox)
             return response
         except requests.ConnectionError:
             # in case connection is down but you still have an old cache
             # you may want to keep it for now
+            response = self.cache.get(hashcode)
+            if response is not None:
+                return response
+            raise
+
+    async def aquery(
+        self,
+        query_str: str,
+        requests_extra: Optional[Dict[str, str]] = None,
+        spec: Optional[str] = None,
+        bbox: Optional[Tuple[float, ...]] = None,
+    ) -> Response:
+        """Asynchronous version of query.
+
+        Cache accesses and parsing run in the default executor; downloads
+        share the aiohttp session and concurrency limit of cartotools.aio.
+        """
+        from ..singleflight import flights
+
+        return await flights.ado(
+            "overpass",
+            self.hashcode(query_str),
+            self._aquery,
+            query_str,
+            requests_extra,
+            spec,
+            bbox,
+        )
+
+    async def _aquery(
+        self,
+        query_str: str,
+        requests_extra: Optional[Dict[str, str]] = None,
+        spec: Optional[str] = None,
+        bbox: Optional[Tuple[float, ...]] = None,
+    ) -> Response:
+        import aiohttp  # leave it as optional import
+
+        from .. import aio
+        from ..scheduler import scheduler
+
+        if requests_extra is None:
+            requests_extra = dict()
+
+        hashcode = self.hashcode(query_str)
+        last_modification = await aio.run(self.cache.timestamp, hashcode)
+        if self.fresh(last_modification):
+            response = await aio.run(self.cache.get, hashcode)
+            if response is not None:
+                logging.info(
+                    f"Footprint loaded from cache: {last_modification}"
+                )
+                return response
+        elif last_modification is not None:
+            if self.incremental:
+                response = await aio.run(
+                    self.refresh, query_str, requests_extra
+                )
+                if response is not None:
+                    return response
+            logging.warning(
+                "Expired cache files. Downloading now from OpenStreetMap."
+            )
+
+        try:
+            logging.info(
+                f"Sending the following request: {query_str} to {self.url}"
+            )
+            reply = await scheduler.arequest(
+                "POST", self.url, data=query_str, **requests_extra
+            )
+        except aiohttp.ClientConnectionError:
+            # in case connection is down but you still have an old cache
+            response = await aio.run(self.cache.get, hashcode)
             if response is not None:
                 return response
             raise
 
+        response = await aio.run(
+            Response.from_stream, [reply.content], hashcode, lazy=True
+        )
+        await aio.run(
+            self.cache.save, hashcode, response, query_str, spec, bbox
+        )
+        return response
+
+    def refresh(
+        self,
+        query_str: str,
+        requests_extra: Optional[Dict[str, str]] = None,
+    ) -> Optional[Response]:
+        """Update a cached response with the changes since its timestamp.
+
+        The query is sent again as an augmented diff ([adiff:...]) and only
+        created, modified and deleted elements are downloaded. Returns None
+        if the response is not cached or if the diff can't be applied.
+        """
+        from ..scheduler import scheduler
+
+        if requests_extra is None:
+            requests_extra = dict()
+
+        hashcode = self.hashcode(query_str)
+        entry = self.cache.manifest.get(hashcode)
+        cached = self.cache.get(hashcode)
+        if entry is None or entry.timestamp is None or cached is None:
+            return None
+
+        diff_query = query_str.replace(
+            "[out:json]", f'[out:xml][adiff:"{entry.timestamp}"]', 1
+        )
+        try:
+            logging.info(
+                f"Sending the following request: {diff_query} to {self.url}"
+            )
+            response = scheduler.request(
+                "POST", self.url, data=diff_query, stream=True, **requests_extra
+            )
+            response.raise_for_status()
+            diff = parse_adiff(response.iter_content(chunk_size))
+        except (requests.RequestException, ParseError) as e:
+            logging.warning(f"Incremental update failed: {e}")
+            return None
+
+        logging.info(
+            f"Applying {len(diff.upserts)} updates "
+            f"and {len(diff.deletes)} deletions to {hashcode}"
+        )
+        response = cached.apply_diff(diff)
+        bbox = None
+        if entry.west is not None:
+            bbox = entry.west, entry.south, entry.east, entry.north
+        self.cache.save(hashcode, response, query_str, entry.spec, bbox)
+        return response
+
     # more natural than a subsequent call to json_request!
     def __call__(
         self, where: Optional[LocationType] = None, **kwargs
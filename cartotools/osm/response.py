@@ -0,0 +1,628 @@
+from collections.abc import Mapping
+from itertools import chain
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+import numpy as np
+from shapely.geometry import Point, Polygon, base, box
+from shapely.prepared import prep
+
+try:  # vectorized predicates and spatial queries need shapely >= 2.0
+    import shapely
+    from shapely import STRtree, intersects_xy
+except ImportError:
+    STRtree = intersects_xy = None
+
+from .core import ShapelyMixin, union
+from .diff import Diff
+from .elements import NodeStore, Ways, elements_nbytes, shapes_nbytes
+from .index import TagIndex
+from .multipolygon import relation_geometries
+from .stream import iter_elements
+
+__all__ = ["Response"]
+
+
+def geometries(where: Any) -> np.ndarray:
+    """Array of geometries from a geometry, a list of geometries, an (n, 2)
+    array of points (lon, lat) or an (n, 4) array of bounding boxes (west,
+    south, east, north)."""
+    if isinstance(where, base.BaseGeometry):
+        return np.array([where], dtype=object)
+    if len(where) > 0 and isinstance(where[0], base.BaseGeometry):
+        return np.array(list(where), dtype=object)
+    coords = np.atleast_2d(np.asarray(where, dtype=float))
+    if coords.shape[1] == 2:
+        return shapely.points(coords)
+    if coords.shape[1] == 4:
+        return shapely.box(*coords.T)
+    raise ValueError("Expected points (n, 2) or bounding boxes (n, 4)")
+
+
+def outline(shape: base.BaseGeometry) -> base.BaseGeometry:
+    """Closed ways are matched on their nodes, as in Overpass, not on the
+    area they enclose."""
+    return shape.exterior if isinstance(shape, Polygon) else shape
+
+
+class Response(ShapelyMixin):
+
+    # processes computing the union of ways in shape, None for none
+    union_workers: Optional[int] = None
+
+    def __init__(
+        self, response: Dict[str, Any], name: str, lazy: bool = False
+    ) -> None:
+        header = {
+            key: value for key, value in response.items() if key != "elements"
+        }
+        self._load(header, response["elements"], name, lazy)
+
+    @classmethod
+    def from_stream(
+        cls,
+        chunks: Iterable[Union[bytes, str]],
+        name: str,
+        lazy: bool = False,
+    ) -> "Response":
+        """Build a Response while parsing the JSON payload chunk by chunk."""
+        header: Dict[str, Any] = dict()
+        response = cls.__new__(cls)
+        response._load(header, iter_elements(chunks, header), name, lazy)
+        return response
+
+    @classmethod
+    def merge(cls, responses: Iterable["Response"], name: str) -> "Response":
+        """Merge responses into one, without duplicate elements."""
+        responses = list(responses)
+        if len(responses) == 0:
+            raise ValueError("No response to merge")
+
+        ids, first = np.unique(
+            np.concatenate([r.nodes.ids for r in responses]), return_index=True
+        )
+        nodes = NodeStore(
+            ids,
+            np.concatenate([r.nodes.lon for r in responses])[first],
+            np.concatenate([r.nodes.lat for r in responses])[first],
+            {k: v for r in responses for k, v in r.nodes.attributes.items()},
+        )
+
+        # the oldest timestamp is the one to trust
+        header = dict(responses[0].header)
+        timestamps = [
+            r.header["osm3s"]["timestamp_osm_base"]
+            for r in responses
+            if "timestamp_osm_base" in r.header.get("osm3s", {})
+        ]
+        if len(timestamps) > 0:
+            header["osm3s"] = dict(
+                header.get("osm3s", {}), timestamp_osm_base=min(timestamps)
+            )
+
+        response = cls.from_stores(
+            header,
+            nodes,
+            {k: v for r in responses for k, v in r.ways.meta.items()},
+            {k: v for r in responses for k, v in r.relations.items()},
+            {k: v for r in responses for k, v in r.areas.items()},
+            name,
+            lazy=True,
+        )
+        for r in responses:
+            response.ways.shapes.update(r.ways.shapes)
+        return response
+
+    def _load(
+        self,
+        header: Dict[str, Any],
+        elements: Iterable[Dict[str, Any]],
+        name: str,
+        lazy: bool,
+    ) -> None:
+        others: Dict[str, List[Dict]] = {"way": [], "relation": [], "area": []}
+
+        def dispatch() -> Iterator[Dict[str, Any]]:
+            # nodes go straight to the node store, never into a list
+            for p in elements:
+                if p["type"] == "node":
+                    yield p
+                elif p["type"] in others:  # skip e.g. count elements
+                    others[p["type"]].append(p)
+
+        nodes = NodeStore.from_elements(dispatch())
+        self._init_stores(
+            header,
+            nodes,
+            {p["id"]: p for p in others["way"]},
+            {p["id"]: p for p in others["relation"]},
+            {p["id"]: p for p in others["area"]},
+            name,
+            lazy,
+        )
+
+    @classmethod
+    def from_stores(
+        cls,
+        header: Dict[str, Any],
+        nodes: NodeStore,
+        ways: Mapping[int, Dict[str, Any]],
+        relations: Dict[int, Dict[str, Any]],
+        areas: Dict[int, Dict[str, Any]],
+        name: str,
+        lazy: bool = False,
+    ) -> "Response":
+        """Build a Response from already decoded elements."""
+        response = cls.__new__(cls)
+        response._init_stores(header, nodes, ways, relations, areas, name, lazy)
+        return response
+
+    def _init_stores(
+        self,
+        header: Dict[str, Any],
+        nodes: NodeStore,
+        ways: Mapping[int, Dict[str, Any]],
+        relations: Dict[int, Dict[str, Any]],
+        areas: Dict[int, Dict[str, Any]],
+        name: str,
+        lazy: bool,
+    ) -> None:
+        self.header = header
+        self.nodes = nodes
+
+        self.ways = Ways(self.nodes, ways)
+        if not lazy:
+            self.ways.materialize()
+
+        self.relations = relations
+        self.areas = areas
+
+        self._tag_index: Optional[TagIndex] = None
+        self._shape: Optional[base.BaseGeometry] = None
+        self._multipolygons: Optional[Dict[int, base.BaseGeometry]] = None
+        self._relations_nbytes: Optional[int] = None
+        # whether shape and multipolygons are built, and their size
+        self._built_nbytes: Tuple[Tuple[bool, bool], int] = ((False, False), 0)
+        self._tree: Optional[STRtree] = None
+        self._tree_ids: Optional[np.ndarray] = None
+
+        self.display_name: str = name  # TODO improve
+
+    @property
+    def response(self) -> Dict[str, Any]:
+        """The JSON response, as sent by Overpass."""
+        return {**self.header, "elements": list(self.elements())}
+
+    def elements(self) -> Iterator[Dict[str, Any]]:
+        return chain(
+            self.nodes.values(),
+            self.ways.meta.values(),
+            self.relations.values(),
+            self.areas.values(),
+        )
+
+    @property
+    def nbytes(self) -> int:
+        """Rough estimate of the memory used by elements and shapes.
+
+        The estimate grows as shapes are built, e.g. with shape.
+        """
+        if self._relations_nbytes is None:
+            self._relations_nbytes = elements_nbytes(
+                [self.relations, self.areas]
+            )
+        built = (self._shape is not None, self._multipolygons is not None)
+        if self._built_nbytes[0] != built:
+            shapes = [] if self._shape is None else [self._shape]
+            if self._multipolygons is not None:
+                shapes.extend(self._multipolygons.values())
+            self._built_nbytes = built, shapes_nbytes(shapes)
+        return (
+            self.nodes.nbytes
+            + self.ways.nbytes
+            + self._relations_nbytes
+            + self._built_nbytes[1]
+        )
+
+    @property
+    def shape(self) -> base.BaseGeometry:
+        """Union of all ways (of all nodes if no way), computed once."""
+        if self._shape is None:
+            if len(self.ways) > 0:
+                ids = self.ways.packed().ids.tolist()
+                self.ways.materialize(ids)
+                self._shape = union(
+                    [self.ways.shapes[key] for key in ids],
+                    self.ways.bounds(),
+                    max_workers=self.union_workers,
+                )
+            else:
+                self._shape = union(list(self))
+        return self._shape
+
+    @property
+    def multipolygons(self) -> Dict[int, base.BaseGeometry]:
+        """(Multi)Polygons of multipolygon and boundary relations, by id.
+
+        Member ways and their nodes must be part of the response, e.g.
+        with a query on relations followed by (._;>;); in Overpass QL.
+        """
+        if self._multipolygons is None:
+            self._multipolygons = relation_geometries(
+                self.nodes, self.ways.meta, self.relations.values()
+            )
+        return self._multipolygons
+
+    @property
+    def bounds(self) -> Tuple[float, float, float, float]:
+        # computed on coordinates, without building the shape
+        if len(self.ways) > 0:
+            b = self.ways.bounds()
+        elif len(self.nodes) > 0:
+            lon, lat = self.nodes.lon, self.nodes.lat
+            b = np.column_stack([lon, lat, lon, lat])
+        else:
+            return self.shape.bounds
+        west, south = np.nanmin(b[:, :2], axis=0)
+        east, north = np.nanmax(b[:, 2:], axis=0)
+        return float(west), float(south), float(east), float(north)
+
+    def __iter__(self):
+        if len(self.ways) > 0:
+            for p in self.ways.values():
+                yield p[1]
+            return
+        for lon, lat in zip(self.nodes.lon, self.nodes.lat):
+            yield Point(lon, lat)
+
+    @property
+    def tag_index(self) -> TagIndex:
+        if self._tag_index is None:
+            self._tag_index = TagIndex(
+                chain(
+                    self.nodes.tagged(),
+                    self.ways.meta.values(),
+                    self.relations.values(),
+                )
+            )
+        return self._tag_index
+
+    def filter(
+        self,
+        how: str = "all",
+        elements: Iterable[str] = ("node", "way", "relation"),
+        **tags,
+    ) -> Iterator[Dict]:
+        """Iterate on elements whose tags match all (or any) conditions.
+
+        See TagIndex for the syntax of conditions, e.g.:
+        >>> response.filter(aeroway=re.compile("runway|taxiway"), ref=None)
+        """
+        stores = {
+            "node": self.nodes,
+            "way": self.ways.meta,
+            "relation": self.relations,
+        }
+        for element in elements:
+            for key in sorted(self.tag_index.select(element, how, **tags)):
+                yield stores[element][key]
+
+    def subset(
+        self, **kwargs
+    ) -> Iterator[Tuple[str, Tuple[Dict, base.BaseGeometry]]]:
+        # ways matching any of the conditions, each of them only once
+        keys = sorted(self.tag_index.select("way", "any", **kwargs))
+        self.ways.materialize(keys)
+        for key in keys:
+            yield key, self.ways[key]
+
+    def keys(self, elements: Iterable[str] = ("way",)) -> Set[str]:
+        return set().union(
+            *(self.tag_index.keys(element) for element in elements)
+        )
+
+    def values(self, key: str, elements: Iterable[str] = ("way",)) -> Set[str]:
+        return set().union(
+            *(self.tag_index.values(element, key) for element in elements)
+        )
+
+    def apply_diff(self, diff: Diff) -> "Response":
+        """A new Response, with elements created, modified or deleted."""
+        types = ["node", "way", "relation"]
+        removed: Dict[str, Set[int]] = {type_: set() for type_ in types}
+        for type_, key in diff.deletes:
+            removed[type_].add(key)
+        upserts: Dict[str, Dict[int, Dict]] = {type_: {} for type_ in types}
+        for p in diff.upserts:
+            upserts[p["type"]][p["id"]] = p
+            removed[p["type"]].add(p["id"])
+
+        drop = np.fromiter(removed["node"], dtype=np.int64)
+        keep = ~np.isin(self.nodes.ids, drop)
+        added = NodeStore.from_elements(upserts["node"].values())
+        ids, first = np.unique(
+            np.concatenate([self.nodes.ids[keep], added.ids]),
+            return_index=True,
+        )
+        attributes = {
+            key: value
+            for key, value in self.nodes.attributes.items()
+            if key not in removed["node"]
+        }
+        attributes.update(added.attributes)
+        nodes = NodeStore(
+            ids,
+            np.concatenate([self.nodes.lon[keep], added.lon])[first],
+            np.concatenate([self.nodes.lat[keep], added.lat])[first],
+            attributes,
+        )
+
+        def update(elements: Mapping, type_: str) -> Dict[int, Dict]:
+            result = {
+                key: value
+                for key, value in elements.items()
+                if key not in removed[type_]
+            }
+            result.update(upserts[type_])
+            return result
+
+        header = dict(self.header)
+        if diff.timestamp is not None:
+            header["osm3s"] = dict(
+                header.get("osm3s", {}), timestamp_osm_base=diff.timestamp
+            )
+
+        return Response.from_stores(
+            header,
+            nodes,
+            update(self.ways.meta, "way"),
+            update(self.relations, "relation"),
+            self.areas,
+            self.display_name,
+            lazy=True,
+        )
+
+    @property
+    def spatial_index(self) -> STRtree:
+        """STR-tree on ways (on nodes if no way), built on first access.
+
+        The ids of indexed elements follow in _tree_ids.
+        """
+        if STRtree is None:
+            raise ImportError("Spatial queries need shapely >= 2.0")
+        if self._tree is None:
+            if len(self.ways) > 0:
+                ids = self.ways.packed().ids
+                self.ways.materialize(ids.tolist())
+                shapes = np.array(
+                    [self.ways.shapes[key] for key in ids.tolist()],
+                    dtype=object,
+                )
+            else:
+                ids = self.nodes.ids
+                shapes = shapely.points(self.nodes.lon, self.nodes.lat)
+            self._tree = STRtree(shapes)
+            self._tree_ids = np.asarray(ids)
+        return self._tree
+
+    def query(self, where: Any, predicate: Optional[str] = None) -> np.ndarray:
+        """Ids of ways (nodes if no way) matching where.
+
+        Without predicate, elements are matched if their bounding boxes
+        intersect; predicate may be "intersects", "within", "contains",
+        "crosses", "touches", etc.
+
+        where may be a geometry, or several of them at once (see
+        geometries()): a (2, n) array is then returned, with indices of the
+        input geometries in the first row and matching ids in the second.
+        """
+        tree = self.spatial_index
+        if isinstance(where, base.BaseGeometry):
+            return self._tree_ids[tree.query(where, predicate=predicate)]
+        idx = tree.query(geometries(where), predicate=predicate)
+        return np.vstack([idx[0], self._tree_ids[idx[1]]])
+
+    def nearest(
+        self, where: Any, max_distance: Optional[float] = None
+    ) -> Union[int, np.ndarray]:
+        """Id of the nearest way (node if no way) to each geometry in where.
+
+        where may be a geometry, or several of them at once (see
+        geometries()), e.g. an (n, 2) array of aircraft positions.
+        Distances are in degrees; -1 is returned when nothing lies within
+        max_distance.
+        """
+        shapes = geometries(where)
+        idx = self.spatial_index.query_nearest(
+            shapes, max_distance=max_distance, all_matches=False
+        )
+        result = np.full(len(shapes), -1, dtype=np.int64)
+        result[idx[0]] = self._tree_ids[idx[1]]
+        if isinstance(where, base.BaseGeometry):
+            return int(result[0])
+        return result
+
+    def clip(self, where: Any) -> Union["Response", List["Response"]]:
+        """Elements within a bounding box (west, south, east, north) or a shape.
+
+        Following Overpass semantics, ways are kept with all their nodes,
+        relations with all their members.
+
+        Several bounding boxes or shapes may be passed at once (see
+        geometries()): ways are then matched in one query on the spatial
+        index, and a list of responses is returned.
+        """
+        packed = self.ways.packed()
+        standalone = ~np.isin(self.nodes.ids, packed.refs)
+
+        if not isinstance(where, base.BaseGeometry) and (
+            len(where) == 0
+            or isinstance(where[0], base.BaseGeometry)
+            or np.ndim(where) > 1
+        ):
+            shapes = geometries(where)
+            if len(self.ways) > 0 and len(shapes) > 0:
+                idx = self.query(shapes, predicate="intersects")
+            else:
+                idx = np.empty((2, 0), dtype=np.int64)
+            # group matching ids by input geometry
+            order = np.argsort(idx[0], kind="stable")
+            splits = np.searchsorted(idx[0][order], np.arange(len(shapes) + 1))
+            return list(
+                self._select(
+                    geometry,
+                    False,
+                    self._crossing(geometry, idx[1][order[start:stop]]),
+                    standalone,
+                )
+                for geometry, start, stop in zip(
+                    shapes, splits[:-1], splits[1:]
+                )
+            )
+
+        if isinstance(where, base.BaseGeometry):
+            geometry, is_box = where, False
+        else:
+            geometry, is_box = box(*where), True
+
+        if self._tree is not None and len(self.ways) > 0:
+            way_ids = self._crossing(
+                geometry, self.query(geometry, "intersects")
+            )
+            return self._select(geometry, is_box, way_ids, standalone)
+
+        west, south, east, north = geometry.bounds
+        prepared = prep(geometry)
+
+        # ways: filter on bounds first, test the actual shape if needed
+        b = self.ways.bounds()
+        candidate = (
+            (b[:, 0] <= east)
+            & (b[:, 2] >= west)
+            & (b[:, 1] <= north)
+            & (b[:, 3] >= south)
+        )
+        inside = candidate & (
+            (b[:, 0] >= west)
+            & (b[:, 2] <= east)
+            & (b[:, 1] >= south)
+            & (b[:, 3] <= north)
+        )
+        keep = inside if is_box else np.zeros(len(b), dtype=bool)
+        test = packed.ids[candidate & ~keep].tolist()
+        self.ways.materialize(test)
+        keep[candidate & ~keep] = [
+            prepared.intersects(outline(self.ways.shapes[key])) for key in test
+        ]
+        way_ids = set(packed.ids[keep].tolist())
+
+        return self._select(geometry, is_box, way_ids, standalone)
+
+    def _crossing(
+        self, geometry: base.BaseGeometry, way_ids: Iterable[int]
+    ) -> Set[int]:
+        """Refine ways matched by the spatial index (see outline())."""
+        prepared = prep(geometry)
+        shapes = self.ways.shapes
+        return set(
+            key
+            for key in np.asarray(way_ids).tolist()
+            if not isinstance(shapes[key], Polygon)
+            or prepared.intersects(outline(shapes[key]))
+        )
+
+    def _select(
+        self,
+        geometry: base.BaseGeometry,
+        is_box: bool,
+        way_ids: Set[int],
+        standalone: np.ndarray,
+    ) -> "Response":
+        """Build the response for clip() from the selected ways."""
+        west, south, east, north = geometry.bounds
+
+        # nodes: those of selected ways, and standalone nodes within
+        lon, lat = self.nodes.lon, self.nodes.lat
+        within = (
+            standalone
+            & (lon >= west)
+            & (lon <= east)
+            & (lat >= south)
+            & (lat <= north)
+        )
+        if not is_box and intersects_xy is not None:
+            within[within] = intersects_xy(geometry, lon[within], lat[within])
+        elif not is_box:
+            prepared = prep(geometry)
+            within[within] = [
+                prepared.intersects(Point(x, y))
+                for x, y in zip(lon[within], lat[within])
+            ]
+        node_ids = set(self.nodes.ids[within].tolist())
+
+        # relations with at least one selected member, with all members
+        relations = {
+            key: rel
+            for key, rel in self.relations.items()
+            if any(
+                (m["type"] == "way" and m["ref"] in way_ids)
+                or (m["type"] == "node" and m["ref"] in node_ids)
+                for m in rel.get("members", [])
+            )
+        }
+        for rel in relations.values():
+            for m in rel.get("members", []):
+                if m["type"] == "way" and m["ref"] in self.ways.meta:
+                    way_ids.add(m["ref"])
+                elif m["type"] == "node" and m["ref"] in self.nodes:
+                    node_ids.add(m["ref"])
+
+        ways = {key: self.ways.meta[key] for key in sorted(way_ids)}
+        for way in ways.values():
+            node_ids.update(way["nodes"])
+
+        mask = np.isin(self.nodes.ids, np.fromiter(node_ids, dtype=np.int64))
+        nodes = NodeStore(
+            self.nodes.ids[mask],
+            self.nodes.lon[mask],
+            self.nodes.lat[mask],
+            {
+                key: value
+                for key, value in self.nodes.attributes.items()
+                if key in node_ids
+            },
+        )
+
+        response = Response.from_stores(
+            self.header,
+            nodes,
+            ways,
+            relations,
+            self.areas,
+            self.display_name,
+            lazy=True,
+        )
+        response.ways.shapes.update(
+            (key, shape)
+            for key, shape in self.ways.shapes.items()
+            if key in way_ids
+        )
+        return response
+
+    @property
+    def related(self) -> Dict[int, List[Dict]]:
+        return {
+            key: list(
+                elt for elt in rel["members"] if elt["type"] == "relation"
+            )
+            for key, rel in self.relations.items()
+        }
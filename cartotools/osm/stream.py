@@ -0,0 +1,116 @@
+import codecs
+import json
+import re
+from typing import IO, Any, Dict, Iterable, Iterator, Union
+
+__all__ = ["iter_elements", "dump"]
+
+chunk_size = 1 << 16
+
+whitespace = re.compile(r"[ \t\n\r]*")
+
+
+class _Reader(object):
+    """Text buffer over an iterable of chunks, consumed from the left."""
+
+    def __init__(self, chunks: Iterable[Union[bytes, str]]) -> None:
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        """Read one more chunk; False when the input is exhausted."""
+        if self.eof:
+            return False
+        for chunk in self.chunks:
+            if isinstance(chunk, bytes):
+                chunk = self.decoder.decode(chunk)
+            if chunk:
+                self.buffer = self.buffer[self.pos :] + chunk
+                self.pos = 0
+                return True
+        self.eof = True
+        return False
+
+    def peek(self) -> str:
+        """Next non-whitespace character, without consuming it."""
+        while True:
+            self.pos = whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise json.JSONDecodeError(
+                    "Unexpected end of data", self.buffer, self.pos
+                )
+
+    def expect(self, chars: str) -> str:
+        char = self.peek()
+        if char not in chars:
+            raise json.JSONDecodeError(
+                f"Expecting one of {chars!r}", self.buffer, self.pos
+            )
+        self.pos += 1
+        return char
+
+    def value(self, decoder=json.JSONDecoder()) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+                # a number may be cut by the end of the current chunk;
+                # keys are followed by a colon
+                if self.eof or (
+                    end < len(self.buffer) and self.buffer[end] in " \t\n\r,:]}"
+                ):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iter_elements(
+    chunks: Iterable[Union[bytes, str]], header: Dict[str, Any]
+) -> Iterator[Dict[str, Any]]:
+    """Parse an Overpass JSON response incrementally.
+
+    Elements are yielded one by one, as soon as they are decoded; all other
+    fields of the response are stored in header. Only the current element
+    is kept in memory, on top of the chunk being read.
+    """
+    reader = _Reader(chunks)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        key = reader.value()
+        reader.expect(":")
+        if key == "elements":
+            reader.expect("[")
+            if reader.peek() != "]":
+                while True:
+                    yield reader.value()
+                    if reader.expect(",]") == "]":
+                        break
+            else:
+                reader.expect("]")
+        else:
+            header[key] = reader.value()
+        if reader.expect(",}") == "}":
+            return
+
+
+def dump(
+    header: Dict[str, Any], elements: Iterable[Dict[str, Any]], fh: IO[str]
+) -> None:
+    """Write an Overpass JSON response one element at a time."""
+    fh.write(json.dumps(header)[:-1])
+    fh.write(', "elements": [' if len(header) > 0 else '"elements": [')
+    for i, element in enumerate(elements):
+        if i > 0:
+            fh.write(",\n")
+        fh.write(json.dumps(element))
+    fh.write("]}")
@@ -0,0 +1,135 @@
+"""Shared scheduler for all HTTP requests sent by cartotools.
+
+Requests are throttled per host with a token bucket, and retried with a
+jittered exponential backoff when servers are overloaded, following the
+Retry-After header when they send one.
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+__all__ = ["scheduler"]
+
+
+class TokenBucket(object):
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate  # requests per second
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token; return how long to wait before using it."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.last) * self.rate
+            )
+            self.last = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class Scheduler(object):
+
+    # requests per second and burst size, per host; others are unlimited
+    rates: Dict[str, Tuple[float, int]] = {
+        # https://operations.osmfoundation.org/policies/nominatim/
+        "nominatim.openstreetmap.org": (1.0, 1)
+    }
+
+    max_retries = 5
+    backoff = 1.0  # seconds, doubled at each attempt
+    max_backoff = 60.0
+
+    # 429 is 'too many requests' and 50x are errors from server overload
+    retry_statuses = {429, 502, 503, 504}
+
+    def __init__(self) -> None:
+        self.buckets: Dict[str, TokenBucket] = dict()
+        self.lock = threading.Lock()
+
+    def configure(self, host: str, rate: float, burst: int = 1) -> None:
+        """Limit requests to host to rate per second."""
+        with self.lock:
+            self.rates = dict(self.rates)
+            self.rates[host] = (rate, burst)
+            self.buckets.pop(host, None)
+
+    def wait(self, url: str) -> float:
+        """How long to wait before sending a request to url."""
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.rates:
+                return 0.0
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(*self.rates[host])
+            bucket = self.buckets[host]
+        return bucket.reserve()
+
+    def delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """How long to wait before retrying, after attempt failed."""
+        if retry_after is not None:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                pass
+            try:
+                date = parsedate_to_datetime(retry_after)
+                return max(0.0, date.timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+        # full jitter
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2**attempt)
+        )
+
+    def request(self, method: str, url: str, **kwargs):
+        """Send a request with the requests session of cartotools."""
+        from . import session
+
+        for attempt in range(self.max_retries + 1):
+            time.sleep(self.wait(url))
+            response = session.request(method, url, **kwargs)
+            if (
+                response.status_code not in self.retry_statuses
+                or attempt == self.max_retries
+            ):
+                return response
+            delay = self.delay(attempt, response.headers.get("Retry-After"))
+            logging.warning(
+                f"Error {response.status_code} from {url}, "
+                f"retrying in {delay:.1f}s"
+            )
+            response.close()
+            time.sleep(delay)
+
+    async def arequest(self, method: str, url: str, **kwargs):
+        """Send a request with the aiohttp session of cartotools.aio."""
+        from . import aio
+
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(self.wait(url))
+            response = await aio.request(method, url, **kwargs)
+            if (
+                response.status not in self.retry_statuses
+                or attempt == self.max_retries
+            ):
+                return response
+            delay = self.delay(attempt, response.headers.get("Retry-After"))
+            logging.warning(
+                f"Error {response.status} from {url}, retrying in {delay:.1f}s"
+            )
+            await asyncio.sleep(delay)
+
+
+scheduler = Scheduler()
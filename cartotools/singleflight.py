@@ -0,0 +1,113 @@
+"""Single-flight execution of concurrent identical requests.
+
+The first caller for a key does the work; callers for the same key in the
+meantime wait for its result (or exception) instead of downloading the
+same content again. With interprocess set, a file lock in the cache
+directory extends this to processes sharing user_cache_dir("cartotools").
+"""
+
+import asyncio
+import hashlib
+import threading
+import weakref
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, Tuple
+
+from appdirs import user_cache_dir
+
+__all__ = ["flights"]
+
+
+class Call(object):
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Any = None
+
+
+@contextmanager
+def file_lock(filename: Path) -> Iterator[None]:
+    import fcntl  # leave it as optional import (POSIX only)
+
+    with filename.open("a") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+class SingleFlight(object):
+
+    # also serialise identical requests across processes
+    interprocess = False
+
+    # number of lock files in the cache directory, whatever the keys
+    lockfiles = 256
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.calls: Dict[Tuple[str, str], Call] = dict()
+        self.tasks: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self.lockdir = Path(user_cache_dir("cartotools")) / "locks"
+
+    def lockfile(self, group: str, key: str) -> Path:
+        # a fixed set of lock files, shared by keys with the same digest
+        if not self.lockdir.exists():
+            self.lockdir.mkdir(parents=True, exist_ok=True)
+        digest = hashlib.md5(f"{group}:{key}".encode()).digest()
+        slot = int.from_bytes(digest[:4], "big") % self.lockfiles
+        return self.lockdir / f"{slot}.lock"
+
+    def do(self, group: str, key: str, function: Callable, *args) -> Any:
+        """Run function(*args) once for concurrent calls with same key.
+
+        Functions should check the cache again before downloading: with
+        interprocess set, another process may have done the job while the
+        file lock was waited for.
+        """
+        with self.lock:
+            call = self.calls.get((group, key), None)
+            leader = call is None
+            if leader:
+                call = self.calls[(group, key)] = Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            if self.interprocess:
+                with file_lock(self.lockfile(group, key)):
+                    call.result = function(*args)
+            else:
+                call.result = function(*args)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[(group, key)]
+            call.done.set()
+
+    async def ado(self, group: str, key: str, function: Callable, *args):
+        """Asynchronous version of do, for coroutine functions.
+
+        Coroutines are deduplicated within an event loop; the file lock
+        does not apply here.
+        """
+        loop = asyncio.get_event_loop()
+        tasks = self.tasks.setdefault(loop, dict())
+        task = tasks.get((group, key), None)
+        if task is None:
+            task = tasks[(group, key)] = loop.create_task(function(*args))
+            task.add_done_callback(lambda _: tasks.pop((group, key), None))
+        # a cancelled waiter must not cancel the others
+        return await asyncio.shield(task)
+
+
+flights = SingleFlight()
@@ -12,5 +12,9 @@ setup(
         "cartotools.osm",
     ],
     author="Xavier Olive",
-    install_requires=['pandas']
+    install_requires=['pandas'],
+    extras_require={'async': ['aiohttp']},
+    entry_points={
+        'console_scripts': ['cartotools-seed=cartotools.img_tiles.seeding:main']
+    },
 )
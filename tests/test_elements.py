@@ -0,0 +1,67 @@
+import time
+
+import numpy as np
+from shapely.geometry import LineString, Polygon
+
+from cartotools.osm.elements import NodeStore, way_geometries
+from cartotools.osm.response import Response
+
+
+def synthetic(n_ways, seed=0):
+    """Overpass payload of n_ways ways of 10 nodes, one in three closed."""
+    rng = np.random.default_rng(seed)
+    xy = rng.random((n_ways * 10, 2))
+    nodes = [
+        dict(type="node", id=i, lon=float(lon), lat=float(lat))
+        for i, (lon, lat) in enumerate(xy)
+    ]
+    ways = []
+    for w in range(n_ways):
+        refs = list(range(10 * w, 10 * w + 10))
+        if w % 3 == 0:
+            refs[-1] = refs[0]
+        ways.append(
+            dict(type="way", id=10**7 + w, nodes=refs, tags={"highway": "x"})
+        )
+    return {"elements": nodes + ways}
+
+
+def test_way_geometries():
+    nodes = NodeStore.from_elements(
+        dict(type="node", id=i, lon=float(i % 2), lat=float(i // 2))
+        for i in range(4)
+    )
+    shapes = way_geometries(
+        nodes,
+        [
+            dict(id=1, nodes=[0, 1, 3, 2, 0]),
+            dict(id=2, nodes=[0, 1, 3]),
+            dict(id=3, nodes=[0]),
+        ],
+    )
+    assert isinstance(shapes[0], Polygon) and shapes[0].area == 1
+    assert isinstance(shapes[1], LineString) and shapes[1].length == 2
+    assert shapes[2].is_empty
+
+
+def test_lazy_and_eager_shapes():
+    payload = synthetic(500)
+    eager = Response(payload, "eager")
+    lazy = Response(payload, "lazy", lazy=True)
+    # a few lone ways first, then all others in one batch
+    for key in lazy.ways:
+        assert lazy.ways[key][1].equals_exact(eager.ways[key][1], 0)
+
+
+def test_response_timing():
+    payload = synthetic(50000)
+
+    start = time.time()
+    response = Response(payload, "synthetic")
+    duration = time.time() - start
+
+    assert len(response.ways) == 50000
+    closed = sum(isinstance(s, Polygon) for _, s in response.ways.values())
+    assert closed == 16667
+    # about 0.5s on a single core, a generous bound against regressions
+    assert duration < 5
@@ -0,0 +1,24 @@
+import re
+
+from cartotools.osm.index import TagIndex
+
+
+def test_match():
+    index = TagIndex(
+        [
+            dict(type="way", id=1, tags={"highway": "primary", "lanes": "2"}),
+            dict(type="way", id=2, tags={"highway": "secondary"}),
+            dict(type="node", id=3, tags={"highway": "stop"}),
+        ]
+    )
+    assert index.match("way", "highway") == {1, 2}
+    assert index.match("way", "highway", "primary") == {1}
+    assert index.match("way", "highway", ["primary", "secondary"]) == {1, 2}
+    assert index.match("way", "highway", re.compile("ary$")) == {1, 2}
+    assert index.match("way", "lanes", "2") == {1}
+    # tag values are strings: other values never match, but do not raise
+    assert index.match("way", "lanes", 2) == set()
+    assert index.select("way", how="any", lanes="2", highway="secondary") == {
+        1,
+        2,
+    }
@@ -0,0 +1,52 @@
+import json
+
+from cartotools.osm.stream import iter_elements
+
+
+def chunked(text, size):
+    for i in range(0, len(text), size):
+        yield text[i : i + size].encode()
+
+
+def test_elements():
+    payload = {
+        "version": 0.6,
+        "generator": "Overpass API",
+        "elements": [
+            {"type": "node", "id": i, "lat": 43.5 + i / 10, "lon": 1.25}
+            for i in range(100)
+        ],
+        "remark": "end",
+    }
+    header = dict()
+    elements = list(iter_elements(chunked(json.dumps(payload), 7), header))
+    assert elements == payload["elements"]
+    assert header == {
+        "version": 0.6,
+        "generator": "Overpass API",
+        "remark": "end",
+    }
+
+
+def test_first_element_is_streamed():
+    payload = json.dumps(
+        {
+            "version": 0.6,
+            "elements": [
+                {"type": "node", "id": i, "lat": 43.5, "lon": 1.25}
+                for i in range(10000)
+            ],
+        }
+    )
+    consumed = 0
+
+    def chunks():
+        nonlocal consumed
+        for chunk in chunked(payload, 1024):
+            consumed += 1
+            yield chunk
+
+    first = next(iter_elements(chunks(), dict()))
+    assert first["id"] == 0
+    # the payload is a few hundred chunks long
+    assert consumed <= 2
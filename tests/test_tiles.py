@@ -0,0 +1,79 @@
+import io
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+from cartotools.img_tiles.cached import Cache, decoded_tiles
+
+
+@pytest.fixture
+def server():
+    """Local tile server, counting the connections it accepts."""
+    buffer = io.BytesIO()
+    Image.new("RGB", (256, 256), (255, 0, 0)).save(buffer, "PNG")
+    png = buffer.getvalue()
+    connections = set()
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep connections alive
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            with lock:
+                connections.add(self.client_address)
+            time.sleep(0.05)  # some latency, as for a remote server
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(png)))
+            self.end_headers()
+            self.wfile.write(png)
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    httpd.connections = connections
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_download_throughput(server, tmp_path):
+    class LocalTiles(Cache):
+        extension = ".png"
+        desired_tile_form = "RGB"
+        max_workers = 8
+
+        def _image_url(self, tile):
+            x, y, z = tile
+            return f"http://127.0.0.1:{server.server_port}/{z}/{x}/{y}.png"
+
+        def tileextent(self, tile):
+            x, y, _ = tile
+            return x, x + 1, -y - 1, -y
+
+        def find_images(self, target_domain, target_z):
+            return [(x, y, target_z) for x in range(10) for y in range(10)]
+
+    tiles = LocalTiles()
+    tiles.cache_directory = str(tmp_path)
+    decoded_tiles.clear()
+
+    new_connections = []
+    for zoom in range(3):  # new tiles at each run
+        before = len(server.connections)
+        start = time.time()
+        img, _, _ = tiles.image_for_domain(None, 5 + zoom)
+        duration = time.time() - start
+        new_connections.append(len(server.connections) - before)
+        assert img.shape == (10 * 256, 10 * 256, 3)
+        # 100 tiles at 50ms each take 5s one by one, 0.6s with 8 workers
+        assert duration < 4
+
+    # at most one connection per worker, then connections are reused
+    assert new_connections[0] <= LocalTiles.max_workers
+    assert new_connections[1:] == [0, 0]